@@ -1,11 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, Response, render_template, request, redirect, session, url_for
 from datetime import datetime
+from functools import wraps
+import hashlib
+import hmac
 import json
 import os
+import metrics
+from durable import write_json
+from export import EXPORT_FORMATS, export_lines, parse_user_numbers
+from repository import UserRepository
+from storage import open_history_store
 
 app = Flask(__name__)  # Define app FIRST
 USER_DATA_FILE = "users.json"
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "1029@tanishk")  # Use env var with fallback
+# Signs the login session cookie. The fallback is derived from the password so every gunicorn worker agrees on it
+app.secret_key = os.environ.get("ADMIN_SECRET_KEY") or hashlib.sha256(f"tanigpt-admin:{ADMIN_PASSWORD}".encode()).hexdigest()
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Other sites can't make a logged-in admin's browser POST a delete
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")  # Where bot workers write their metrics snapshots
+METRICS_MAX_AGE = 4 * float(os.environ.get("METRICS_INTERVAL", 15))
+
+# Same storage settings as main.py; the dashboard pages through its user summary index
+USER_DATA_DIR = "user_data"
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "local")
+STATE_DB = os.environ.get("STATE_DB", os.path.join(USER_DATA_DIR, "state.db"))
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite" if STATE_BACKEND == "sqlite" else "jsonl")
+history_store = open_history_store(
+    STORAGE_BACKEND, USER_DATA_DIR, db_path=os.environ.get("STORAGE_DB"),
+    retention=int(os.environ.get("HISTORY_RETENTION", 0)), history_format=os.environ.get("HISTORY_FORMAT")
+)
+# Bot users can only be deleted from here when the bot keeps its user index in the shared database
+user_index = None
+if STATE_BACKEND == "sqlite":
+    from shared_state import SqliteUserRegistry
+    user_index = SqliteUserRegistry(STATE_DB)
+# The same repository the bot's handlers use; Flask workers are threads, so its blocking calls are fine here
+user_repository = UserRepository(user_index, history_store)
 
 def load_users():
     if os.path.exists(USER_DATA_FILE):
@@ -13,11 +43,29 @@ def load_users():
             return json.load(f)
     return {}
 
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not session.get('admin'):
+            return redirect(url_for('login'))
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.template_filter('datetime')
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else 'never'
+
 @app.route('/ping')  # Now works because app is defined
 def ping():
     print(f"Ping received at {datetime.now()}")
     return "I'm alive!", 200
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus scrape target, summed over every live bot worker
+    snapshots = metrics.load_snapshots(METRICS_DIR, max_age=METRICS_MAX_AGE)
+    return Response(metrics.render(snapshots), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def login():
     return render_template('login.html')
@@ -25,22 +73,60 @@ def login():
 @app.route('/login', methods=['POST'])
 def do_login():
     password = request.form['password']
-    if password == ADMIN_PASSWORD:
+    if hmac.compare_digest(password.encode(), ADMIN_PASSWORD.encode()):
+        session['admin'] = True
         return redirect(url_for('dashboard'))
     return "Invalid password!", 403
 
 @app.route('/dashboard')
+@login_required
 def dashboard():
-    users = load_users()
-    return render_template('dashboard.html', users=users)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    page = max(request.args.get('page', 1, type=int), 1)
+    users, has_next = user_repository.list_users(limit=limit, offset=(page - 1) * limit)
+    total = user_repository.count_users()
+    return render_template(
+        'dashboard.html', users=users, total=total, page=page, limit=limit, has_next=has_next,
+        can_delete=user_index is not None
+    )
+
+@app.route('/export')
+@login_required
+def export():
+    # Streamed straight from the store, one turn at a time
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        return "Unknown export format!", 400
+    try:
+        user_numbers = parse_user_numbers(request.args.get('users'))
+    except ValueError:
+        return "Invalid user numbers!", 400
+    return Response(
+        export_lines(user_repository.iter_turns(user_numbers), fmt),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename=tanigpt-export.{fmt}'}
+    )
+
+@app.route('/search')
+@login_required
+def search():
+    text = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    results, more = user_repository.search(text, after=after, before=before, limit=50) if text else ([], False)
+    # Same cursor rules as the bot's history pages: newest first
+    has_older = more if after is None else True
+    has_newer = more if after is not None else before is not None
+    return render_template('search.html', q=text, results=results, has_older=has_older, has_newer=has_newer)
 
-@app.route('/delete/<user_id>')
+@app.route('/delete/<user_id>', methods=['POST'])
+@login_required
 def delete_user(user_id):
+    user_repository.delete_by_telegram_id(user_id)
     users = load_users()
     if user_id in users:
         del users[user_id]
-        with open(USER_DATA_FILE, 'w') as f:
-            json.dump(users, f, indent=4)
+        write_json(USER_DATA_FILE, users)
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
@@ -0,0 +1,392 @@
+"""Offline load test for the bot's handlers.
+
+Drives the real handlers in main.py with synthetic Telegram updates against a
+fake Telegram bot and a local fake Mistral server, so it needs no network or
+credentials. Each virtual user signs up, sends a number of messages and clears
+its history; the run reports handler latency, throughput and storage I/O.
+
+    python bench.py --users 200 --concurrency 50 --messages 10 --llm-latency 0.5 --stream
+
+With --cold-start N it then starts N fresh processes against the data the run
+left behind and reports how long each takes to import the bot, create the
+application and answer its first user lookup.
+
+With --formats it only compares the history formats (HISTORY_FORMAT) on
+synthetic Hinglish histories: bytes on disk and load/dump time per message,
+for a packed log and for one appended record per message, next to the old
+pretty-printed user_N.json documents.
+
+    python bench.py --formats --history-sizes 50 500 5000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeMistralHandler(BaseHTTPRequestHandler):
+    # Speaks just enough of the /v1/chat/completions API for the mistralai client
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        settings = self.server.settings
+        prompt_tokens = sum(len(m['content']) for m in request['messages']) // 4 + 1
+        words = [f"token{i}" for i in range(settings['tokens'])]
+        base = {'id': 'bench', 'model': request['model'], 'created': int(time.time())}
+
+        if not request.get('stream'):
+            time.sleep(settings['latency'])
+            body = json.dumps(dict(
+                base,
+                object='chat.completion',
+                choices=[{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)}, 'finish_reason': 'stop'}],
+                usage={'prompt_tokens': prompt_tokens, 'completion_tokens': len(words), 'total_tokens': prompt_tokens + len(words)}
+            )).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # latency is the time to first token; the rest arrive token_interval apart
+        time.sleep(settings['latency'])
+        for index, word in enumerate(words):
+            chunk = dict(base, object='chat.completion.chunk',
+                         choices=[{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}])
+            if index == len(words) - 1:
+                chunk['choices'][0]['finish_reason'] = 'stop'
+                chunk['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                                  'total_tokens': prompt_tokens + len(words)}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            if index < len(words) - 1:
+                time.sleep(settings['token_interval'])
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def serve_fake_mistral(port, settings):
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeMistralHandler)
+    server.daemon_threads = True
+    server.settings = settings
+    server.serve_forever()
+
+
+def start_fake_mistral(settings):
+    # Runs in its own process so it doesn't compete with the bot for the GIL
+    probe = ThreadingHTTPServer(('127.0.0.1', 0), FakeMistralHandler)
+    port = probe.server_address[1]
+    probe.server_close()
+    process = multiprocessing.Process(target=serve_fake_mistral, args=(port, settings), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port}"
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: records what the handlers send instead of calling Telegram."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.username = "tanigpt_bench_bot"
+        self.defaults = None
+        self.next_message_id = 0
+        self.sent = 0
+        self.edits = 0
+
+    def _message(self, chat_id, text):
+        from telegram import Chat, Message
+        self.next_message_id += 1
+        message = Message(self.next_message_id, datetime.now(timezone.utc), Chat(chat_id, 'private'), text=text)
+        message.set_bot(self)
+        return message
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return self._message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edits += 1
+        return self._message(chat_id, text)
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return True
+
+
+class VirtualUser:
+    def __init__(self, bot, index):
+        self.bot = bot
+        self.user_id = 100000 + index
+        self.phone = f"9{index:09d}"
+        self.context = types.SimpleNamespace(bot=bot, user_data={}, chat_data={})
+        self.next_update_id = 0
+
+    def update(self, text):
+        from telegram import Update
+        self.next_update_id += 1
+        data = {
+            'update_id': self.next_update_id,
+            'message': {
+                'message_id': self.next_update_id,
+                'date': int(time.time()),
+                'chat': {'id': self.user_id, 'type': 'private'},
+                'from': {'id': self.user_id, 'is_bot': False, 'first_name': 'Bench'},
+                'text': text
+            }
+        }
+        if text.startswith('/'):
+            data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return Update.de_json(data, self.bot)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+async def run(main, args):
+    import metrics
+    bot = FakeBot(latency=args.telegram_latency)
+    latencies = {}
+
+    async def call(handler, user, text):
+        start = time.perf_counter()
+        result = await handler(user.update(text), user.context)
+        latencies.setdefault(handler.__name__, []).append(time.perf_counter() - start)
+        return result
+
+    async def session(index, semaphore):
+        async with semaphore:
+            user = VirtualUser(bot, index)
+            await call(main.start, user, "/start")
+            await call(main.get_name, user, "Bench")
+            await call(main.get_phone, user, user.phone)
+            await call(main.confirm_signup, user, "Confirm")
+            for n in range(args.messages):
+                await call(main.handle_text, user, f"message {n} from user {index}, tell me something new")
+            await call(main.clear, user, "/clear")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    disk_before = directory_size(main.USER_DATA_DIR)
+    started = time.perf_counter()
+    await asyncio.gather(*(session(index, semaphore) for index in range(args.users)))
+    # Handlers return before their replies are sent; wait for the outbox to empty
+    await main.outbox.drain(timeout=None)
+    await main.session_store.close()
+    elapsed = time.perf_counter() - started
+    disk_after = directory_size(main.USER_DATA_DIR)
+
+    texts = len(latencies.get('handle_text', []))
+    updates = sum(len(values) for values in latencies.values())
+    print(f"\n{args.users} users, {args.concurrency} concurrent, {args.messages} messages each, "
+          f"{'streaming' if args.stream else 'non-streaming'}, {main.STORAGE_BACKEND} storage")
+    print(f"{'handler':<16}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in latencies.items():
+        print(f"{name:<16}{len(values):>8}{percentile(values, 0.5) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+    print(f"\nWall time:        {elapsed:.2f} s")
+    print(f"Updates/sec:      {updates / elapsed:.1f}")
+    print(f"Messages/sec:     {texts / elapsed:.1f} (handle_text)")
+    print(f"Telegram calls:   {bot.sent} sends, {bot.edits} edits")
+    print(f"Errors logged:    {sum(value for _, value in metrics.ERRORS.samples())}")
+
+    storage = metrics.registry['tanigpt_storage_seconds'].samples()
+    calls = sum(value['count'] for _, value in storage)
+    seconds = sum(value['sum'] for _, value in storage)
+    print(f"Storage calls:    {calls} ({calls / max(texts, 1):.2f} per message)")
+    for labels, value in sorted(storage):
+        print(f"  {labels[0]:<14}{value['count']:>8} calls{value['sum'] / value['count'] * 1000:>10.2f} ms avg")
+    print(f"Storage time:     {seconds / max(texts, 1) * 1000:.2f} ms per message")
+    print(f"Bytes on disk:    {(disk_after - disk_before) / max(texts, 1):.0f} per message")
+
+
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+created = time.perf_counter()
+main.user_index.find_by_phone("0")
+looked_up = time.perf_counter()
+json.dump({'import': imported - started, 'create_app': created - imported,
+           'first_lookup': looked_up - created}, sys.stdout)
+"""
+
+
+def measure_cold_start(runs):
+    # Each run is a new interpreter, like a worker scaled up from zero
+    results = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT], capture_output=True, text=True, check=True,
+            env=dict(os.environ, PYTHONPATH=SOURCE_DIR)
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process'] = time.perf_counter() - started
+        results.append(result)
+    print(f"\nCold start over {runs} process(es):")
+    print(f"{'phase':<16}{'p50 ms':>10}{'max ms':>10}")
+    for phase in ('import', 'create_app', 'first_lookup', 'process'):
+        values = [result[phase] for result in results]
+        print(f"{phase:<16}{percentile(values, 0.5) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+
+
+FORMATS = ["json", "orjson", "msgpack", "json+zlib", "orjson+zlib", "msgpack+zlib", "json+zstd", "msgpack+zstd"]
+
+HINGLISH_WORDS = (
+    "haan bilkul yaar main tumhe batata hoon ki yeh kaise kaam karta hai dekho pehle toh samajh lo "
+    "basically simple hai agar tum roz thoda practice karo toh sab ho jayega aur tension mat lo "
+    "accha sawaal hai iska answer thoda lamba hai lekin interesting hai chalo shuru karte hain "
+    "music production mein beat sabse important hota hai phir melody aur lyrics aate hain"
+).split()
+
+
+def synthetic_history(turns, seed=0):
+    # Short user messages and long replies, like real chats
+    rng = random.Random(seed)
+    history = [{"role": "system", "content": "You are TaniGPT, powered by Tnix AI."}]
+    for index in range(turns):
+        user = index % 2 == 0
+        words = rng.randint(4, 20) if user else rng.randint(60, 160)
+        content = " ".join(rng.choice(HINGLISH_WORDS) for _ in range(words))
+        history.append({"role": "user" if user else "assistant", "content": content, "ts": 1700000000.0 + index})
+    return history
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def compare_formats(args):
+    from serialization import Serializer
+    print(f"{'turns':>6}  {'format':<16}{'bytes/msg':>10}{'load us/msg':>13}{'dump us/msg':>13}"
+          f"{'appended bytes/msg':>20}{'appended load us/msg':>22}")
+    for turns in args.history_sizes:
+        history = synthetic_history(turns)
+        repeat = max(1, 20000 // turns)
+        document = {'name': 'Bench', 'phone_number': '+919876543210', 'chat_history': history}
+        data = json.dumps(document, indent=4).encode('utf-8')
+        load = timed(lambda: json.loads(data), repeat)
+        dump = timed(lambda: json.dumps(document, indent=4), repeat)
+        print(f"{turns:>6}  {'legacy indent=4':<16}{len(data) / turns:>10.0f}{load / turns * 1e6:>13.2f}"
+              f"{dump / turns * 1e6:>13.2f}{'-':>20}{'-':>22}")
+        for spec in FORMATS:
+            try:
+                serializer = Serializer.from_spec(spec)
+            except ValueError as e:
+                print(f"{turns:>6}  {spec:<16}skipped: {str(e)}")
+                continue
+            packed = serializer.encode(history)
+            appended = b"".join(serializer.encode([turn]) for turn in history)
+            load = timed(lambda: list(serializer.decode(packed)), repeat)
+            dump = timed(lambda: serializer.encode(history), repeat)
+            appended_load = timed(lambda: list(serializer.decode(appended)), repeat)
+            print(f"{turns:>6}  {spec:<16}{len(packed) / turns:>10.0f}{load / turns * 1e6:>13.2f}"
+                  f"{dump / turns * 1e6:>13.2f}{len(appended) / turns:>20.0f}{appended_load / turns * 1e6:>22.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline TaniGPT load test")
+    parser.add_argument("--users", type=int, default=100, help="virtual users to sign up")
+    parser.add_argument("--concurrency", type=int, default=20, help="users active at the same time")
+    parser.add_argument("--messages", type=int, default=10, help="messages each user sends")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake Mistral time to first token (s)")
+    parser.add_argument("--tokens", type=int, default=40, help="tokens per fake reply")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="delay between streamed tokens (s)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="fake Telegram API latency (s)")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=False, help="stream replies")
+    parser.add_argument("--backend", choices=["jsonl", "sqlite"], default="jsonl", help="history storage backend")
+    parser.add_argument("--cold-start", type=int, default=0, metavar="N", help="then time N fresh process starts")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    parser.add_argument("--history-format", default="json", help="HISTORY_FORMAT for the jsonl backend")
+    parser.add_argument("--formats", action="store_true", help="only compare history formats")
+    parser.add_argument("--history-sizes", type=int, nargs="+", default=[50, 500, 5000], help="turns per history for --formats")
+    args = parser.parse_args()
+
+    if args.formats:
+        sys.path.insert(0, SOURCE_DIR)
+        compare_formats(args)
+        return
+
+    process, server_url = start_fake_mistral({
+        'latency': args.llm_latency, 'tokens': args.tokens, 'token_interval': args.token_interval
+    })
+
+    # main.py keeps its data relative to the working directory, so give it an empty one
+    work_dir = tempfile.mkdtemp(prefix="tanigpt-bench-")
+    os.chdir(work_dir)
+    sys.path.insert(0, SOURCE_DIR)
+    os.environ.update(
+        MISTRAL_API_KEY="bench", TELEGRAM_BOT_TOKEN="0:bench", BOT_MODE="polling",
+        STREAM_RESPONSES=str(args.stream).lower(), STORAGE_BACKEND=args.backend, HISTORY_FORMAT=args.history_format
+    )
+    # Production limits would throttle a single process hammering the bot; export these to test them
+    for name, value in [("COALESCE_WINDOW", "0"), ("RATE_LIMIT_USER_PER_MINUTE", "1000000"),
+                        ("RATE_LIMIT_USER_BURST", "1000000"), ("RATE_LIMIT_GLOBAL_PER_SECOND", "1000000"),
+                        ("RATE_LIMIT_GLOBAL_BURST", "1000000"), ("LLM_QUEUE_SIZE", "1000000"),
+                        ("TELEGRAM_GLOBAL_RATE", "1000000"), ("TELEGRAM_CHAT_RATE", "1000000"),
+                        ("TELEGRAM_CHAT_BURST", "1000000")]:
+        os.environ.setdefault(name, value)
+    try:
+        import logging
+        import main as bot_main
+        from mistralai import Mistral
+        logging.getLogger().setLevel(logging.WARNING)
+        bot_main.create_app()
+        bot_main.inference_pool.client = Mistral(api_key="bench", server_url=server_url)
+        asyncio.run(run(bot_main, args))
+        bot_main.inference_pool.shutdown()
+        bot_main.history_store.close()
+        bot_main.storage_committer.close()
+        if args.cold_start:
+            measure_cold_start(args.cold_start)
+    finally:
+        process.terminate()
+        if args.keep:
+            print(f"Data kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+class ResponseCache:
+    """LRU + TTL cache of LLM completions keyed on the model and the normalized messages.
+
+    With stateless_only, only first-turn conversations (system prompt plus one
+    user message) are cached, so replies never depend on someone else's history.
+    """
+
+    def __init__(self, enabled=False, max_entries=1000, ttl=3600, stateless_only=True):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stateless_only = stateless_only
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, model, messages):
+        # None means "don't cache this request"
+        if not self.enabled:
+            return None
+        if self.stateless_only and [m['role'] for m in messages] != ['system', 'user']:
+            return None
+        payload = json.dumps([model] + [[m['role'], normalize(m['content'])] for m in messages])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, response):
+        if key is None:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
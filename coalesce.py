@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Batch:
+    def __init__(self, message_id, text):
+        self.messages = [(message_id, text)]
+        self.started = time.monotonic()
+        self.last = self.started
+        self.closed = False
+
+
+class MessageCoalescer:
+    """Merges messages a chat sends in quick succession into a single LLM turn.
+
+    The first message of a burst becomes the batch leader. collect() returns it
+    the batch once the chat has been quiet for `window` seconds, or after
+    `max_wait` seconds in total. Messages that arrive in the meantime return
+    None: they were absorbed. The batch stays open until the leader calls
+    close(), so messages sent while an earlier reply is still being generated
+    are queued behind it and answered together. Handlers run concurrently and
+    may reach collect() out of order, so close() puts the messages back in
+    `message_id` order.
+    """
+
+    def __init__(self, window=0.8, max_wait=4.0, stale_after=120.0):
+        self.window = window
+        self.max_wait = max_wait
+        self.stale_after = stale_after  # Leader presumably died, start over
+        self.batches = {}
+
+    async def collect(self, chat_id, message_id, text):
+        now = time.monotonic()
+        batch = self.batches.get(chat_id)
+        if batch is not None and not batch.closed and now - batch.started < self.stale_after:
+            batch.messages.append((message_id, text))
+            batch.last = now
+            logger.info(f"Coalesced message into pending batch for chat {chat_id} ({len(batch.messages)} messages)")
+            return None
+
+        batch = self.batches[chat_id] = Batch(message_id, text)
+        while True:
+            remaining = min(batch.last + self.window, batch.started + self.max_wait) - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        return batch
+
+    def close(self, chat_id, batch):
+        # Returns the merged text; later messages start a new batch
+        batch.closed = True
+        if self.batches.get(chat_id) is batch:
+            del self.batches[chat_id]
+        return "\n".join(text for _, text in sorted(batch.messages, key=lambda message: message[0]))
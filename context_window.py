@@ -0,0 +1,96 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough per-message overhead of the chat template, in tokens
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    # ~4 bytes per token for Latin-script English/Hinglish; UTF-8 length makes
+    # emoji and Devanagari count heavier, which is what the tokenizer does too
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD
+
+
+class ContextBuilder:
+    """Builds the message list sent to the LLM from a user's history.
+
+    The system prompt is always first. After it come the newest turns that fit
+    in token_budget. If a summarizer is given, turns that fall out of the window
+    are folded into a rolling summary in the background. The summary is cached
+    on the session and sent along with the system prompt; build()'s on_summary
+    is called with each new summary so the caller can store it.
+    """
+
+    def __init__(self, system_prompt, token_budget=3000, summarizer=None):
+        self.system_prompt = system_prompt
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+
+    def build(self, user_data, history, on_summary=None):
+        turns = [turn for turn in history if turn['role'] != 'system']
+        summary = user_data.get('summary') if self.summarizer else None
+
+        system_content = self.system_prompt
+        if summary:
+            system_content += f"\n\nSummary of the earlier conversation: {summary['text']}"
+        system_message = {"role": "system", "content": system_content}
+
+        remaining = self.token_budget - message_tokens(system_message)
+        kept = []
+        for turn in reversed(turns):
+            cost = message_tokens(turn)
+            # The newest turn is always sent, even if it alone exceeds the budget
+            if kept and cost > remaining:
+                break
+            kept.append(turn)
+            remaining -= cost
+        kept.reverse()
+
+        dropped = turns[:len(turns) - len(kept)]
+        if dropped and self.summarizer:
+            self._schedule_summary(user_data, dropped, on_summary)
+        return [system_message] + kept
+
+    def _schedule_summary(self, user_data, dropped, on_summary=None):
+        summary = user_data.get('summary')
+        if summary:
+            # Only fold turns newer than the last one already summarized; compared by value
+            # because a shared session store reloads turns from the backend
+            index = next((i for i in reversed(range(len(dropped))) if dropped[i] == summary['last']), None)
+            if index is not None:
+                dropped = dropped[index + 1:]
+        if not dropped:
+            return
+        task = user_data.get('summary_task')
+        if task is not None and not task.done():
+            return
+        user_data['summary_task'] = asyncio.get_running_loop().create_task(self._fold(user_data, dropped, on_summary))
+
+    async def forget(self, user_data):
+        # Drops the summary when the history is cleared; a fold still running would write the old one back
+        task = user_data.pop('summary_task', None)
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        user_data.pop('summary', None)
+
+    async def _fold(self, user_data, turns, on_summary=None):
+        previous = user_data.get('summary')
+        try:
+            text = await self.summarizer(previous['text'] if previous else None, turns)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation: {str(e)}")
+            return
+        user_data['summary'] = {'text': text, 'last': turns[-1]}
+        if on_summary is not None:
+            on_summary(user_data['summary'])
+        logger.info(f"Folded {len(turns)} turn(s) into the conversation summary")
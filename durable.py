@@ -0,0 +1,155 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = "quarantine"
+
+
+def fsync_path(path):
+    # Works for directories too, which is what makes a rename durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter:
+    """Batches fsyncs of recently written files into one commit every `interval` seconds.
+
+    Writers call sync(path) after writing instead of fsyncing themselves, so
+    appends from many users in the same interval share a single pass over
+    the dirty files on a background thread. A crash can lose at most the last
+    interval of writes, never leave a torn JSON document behind (see
+    atomic_write). With interval <= 0 every sync() fsyncs immediately.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.commits = 0
+        self.synced = 0
+
+    def sync(self, path):
+        if self.interval <= 0:
+            fsync_path(path)
+            self.synced += 1
+            return
+        with self.lock:
+            self.pending.add(path)
+            if self.thread is None and not self.stopped.is_set():
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            batch, self.pending = self.pending, set()
+        if not batch:
+            return
+        for path in batch:
+            try:
+                fsync_path(path)
+            except FileNotFoundError:
+                pass  # Deleted or replaced since it was written
+            except OSError as e:
+                logger.error(f"Error syncing {path}: {str(e)}")
+        self.commits += 1
+        self.synced += len(batch)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.commit()
+
+
+def atomic_write(path, write, committer=None, encoding='utf-8'):
+    # The file is either the old or the new version after a crash, never a truncated one; encoding=None writes bytes
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w' if encoding else 'wb', encoding=encoding) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    directory = os.path.dirname(path) or "."
+    if committer is not None:
+        committer.sync(directory)
+    else:
+        fsync_path(directory)
+
+
+def write_json(path, data, committer=None, indent=4):
+    atomic_write(path, lambda f: json.dump(data, f, indent=indent), committer)
+
+
+def quarantine(path, reason):
+    # Moves a damaged file aside for inspection instead of deleting it
+    directory = os.path.join(os.path.dirname(path) or ".", QUARANTINE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, f"{os.path.basename(path)}.{int(time.time())}")
+    shutil.move(path, target)
+    logger.warning(f"Quarantined {path} to {target}: {reason}")
+    return target
+
+
+def remove_stale_temps(directory):
+    # Temp files only survive a crash between writing and renaming; the original is intact
+    removed = 0
+    for path in glob.glob(os.path.join(directory, "*.tmp")):
+        os.remove(path)
+        logger.warning(f"Removed {path} left by an interrupted write")
+        removed += 1
+    return removed
+
+
+def repair_torn_tail(path):
+    # Cuts a partially written last line off an append-only log; returns the bytes removed
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+        # Walk back to the previous newline in blocks
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            block = f.read(end - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                keep = start + newline + 1
+                break
+            end = start
+        else:
+            keep = 0
+        f.seek(keep)
+        try:
+            json.loads(f.read())
+            # Only the newline is missing
+            f.write(b"\n")
+            return 0
+        except ValueError:
+            pass
+        f.truncate(keep)
+    logger.warning(f"Truncated torn record at the end of {path} ({size - keep} bytes)")
+    return size - keep
@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("jsonl", "csv")
+EXPORT_FIELDS = ["user_number", "role", "content", "ts"]
+
+
+def export_lines(turns, fmt="jsonl"):
+    # Yields the export a line at a time, so memory stays flat however many turns there are
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == "jsonl":
+        for turn in turns:
+            yield json.dumps({field: turn.get(field) for field in EXPORT_FIELDS}, ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+    # The header is a chunk of its own, so an export without turns still has one
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for turn in turns:
+        writer.writerow(turn)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def parse_user_numbers(text):
+    # "12, 15 20" -> ['12', '15', '20']; empty or "all" means every user
+    text = (text or "").strip()
+    if not text or text.lower() == "all":
+        return None
+    numbers = [part for part in text.replace(',', ' ').split() if part]
+    if not all(number.isdigit() for number in numbers):
+        raise ValueError(f"Invalid user numbers: {text}")
+    return numbers
+
+
+def write_export(history_store, path, user_numbers=None, fmt="jsonl"):
+    # Returns the number of turns written
+    count = 0
+
+    def counted(turns):
+        nonlocal count
+        for turn in turns:
+            count += 1
+            yield turn
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for line in export_lines(counted(history_store.iter_turns(user_numbers)), fmt):
+            f.write(line)
+    logger.info(f"Exported {count} turn(s) to {path}")
+    return count
@@ -0,0 +1,82 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def trie_pattern(words):
+    # Factor common prefixes so matching cost stays flat as keywords are added
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+
+class Intent:
+    def __init__(self, name, handler, keywords=(), patterns=(), emoji=None):
+        self.name = name
+        self.handler = handler
+        self.keywords = [keyword.lower() for keyword in keywords]
+        self.patterns = list(patterns)
+        self.emoji = emoji
+
+
+class IntentRouter:
+    """Answers messages locally when they match a registered intent.
+
+    Intents are registered with the intent() decorator and all of their
+    keywords (substring matches) and regexes are compiled into one pattern,
+    scanned once per message. The pattern is a lookahead, so it reports a match
+    at every position instead of only non-overlapping ones, and its
+    alternatives are in registration order, so each position reports the
+    earliest intent starting there. When a message matches several intents,
+    the one registered first wins.
+    """
+
+    def __init__(self):
+        self.intents = []
+        self.pattern = None
+
+    def intent(self, name, keywords=(), patterns=(), emoji=None):
+        def register(handler):
+            self.intents.append(Intent(name, handler, keywords, patterns, emoji))
+            self.pattern = None
+            return handler
+        return register
+
+    def compile(self):
+        alternatives = []
+        for priority, intent in enumerate(self.intents):
+            branches = [f"(?:{pattern})" for pattern in intent.patterns]
+            if intent.keywords:
+                branches.insert(0, trie_pattern(intent.keywords))
+            if branches:
+                # The intent's group encloses any groups of its own patterns, so it is the match's lastgroup
+                alternatives.append(f"(?P<i{priority}>{'|'.join(branches)})")
+        self.pattern = re.compile(f"(?=(?:{'|'.join(alternatives)}))" if alternatives else r"(?!)", re.IGNORECASE)
+        logger.info(f"Compiled {len(self.intents)} intents ({sum(len(intent.keywords) for intent in self.intents)} keywords)")
+
+    def match(self, message):
+        if self.pattern is None:
+            self.compile()
+        best = None
+        for found in self.pattern.finditer(message):
+            priority = int(found.lastgroup[1:])
+            if best is None or priority < best:
+                best = priority
+                if best == 0:
+                    break
+        return self.intents[best] if best is not None else None
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_SECONDS = metrics.histogram(
+    "tanigpt_llm_seconds", "Mistral AI request time, until the last token when streaming", ("model", "mode")
+)
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "tanigpt_llm_first_token_seconds", "Time until a streamed Mistral AI response yields its first token", ("model",)
+)
+LLM_TOKENS = metrics.counter(
+    "tanigpt_llm_tokens_total", "Tokens reported by Mistral AI usage data", ("model", "kind")
+)
+
+
+def record_usage(model, usage):
+    if usage is not None:
+        LLM_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind='prompt')
+        LLM_TOKENS.inc(usage.completion_tokens or 0, model=model, kind='completion')
+
+
+class InferencePool:
+    """Runs Mistral completions on a bounded worker pool so the event loop never blocks.
+
+    A thread pool (instead of an asyncio.Semaphore) keeps the concurrency limit
+    global even when updates are processed on more than one event loop.
+    """
+
+    def __init__(self, client, model, max_concurrency=8, timeout=60.0, client_factory=None):
+        self._client = client
+        self.client_factory = client_factory  # Builds the client on first use when client is None
+        self._client_lock = threading.Lock()
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="mistral")
+        self.in_flight = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.client_factory()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _complete_sync(self, messages, model):
+        response = self.client.chat.complete(
+            model=model,
+            messages=messages,
+            timeout_ms=int(self.timeout * 1000)
+        )
+        record_usage(model, getattr(response, 'usage', None))
+        return response.choices[0].message.content
+
+    async def complete(self, messages, model=None):
+        model = model or self.model
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        start_time = time.time()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, self._complete_sync, messages, model),
+                timeout=self.timeout
+            )
+        finally:
+            self.in_flight -= 1
+            elapsed = time.time() - start_time
+            LLM_SECONDS.observe(elapsed, model=model, mode='complete')
+            logger.info(f"Mistral AI response time ({model}): {elapsed:.2f} seconds")
+
+    def _stream_sync(self, messages, model, loop, queue, cancelled):
+        # Runs on a worker thread and hands each token delta back to the event loop
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                cancelled.set()  # Loop already closed, nobody is listening
+
+        try:
+            stream = self.client.chat.stream(
+                model=model,
+                messages=messages,
+                timeout_ms=int(self.timeout * 1000)
+            )
+            for event in stream:
+                if cancelled.is_set():
+                    break
+                # Usage arrives with the final chunk
+                record_usage(model, getattr(event.data, 'usage', None))
+                delta = event.data.choices[0].delta.content
+                if delta:
+                    put(delta)
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    async def stream(self, messages, model=None):
+        # Yields text deltas as they arrive; the timeout applies to the wait for each chunk
+        model = model or self.model
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+        self.in_flight += 1
+        start_time = time.time()
+        first_token_time = None
+        loop.run_in_executor(self.executor, self._stream_sync, messages, model, loop, queue, cancelled)
+        try:
+            while True:
+                item = await asyncio.wait_for(queue.get(), timeout=self.timeout)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if first_token_time is None:
+                    first_token_time = time.time()
+                    LLM_FIRST_TOKEN_SECONDS.observe(first_token_time - start_time, model=model)
+                    logger.info(f"Mistral AI first token ({model}): {first_token_time - start_time:.2f} seconds")
+                yield item
+        finally:
+            cancelled.set()
+            self.in_flight -= 1
+            elapsed = time.time() - start_time
+            LLM_SECONDS.observe(elapsed, model=model, mode='stream')
+            logger.info(f"Mistral AI stream time ({model}): {elapsed:.2f} seconds")
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
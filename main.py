@@ -1,26 +1,49 @@
 import os
 import re
 import logging
+import asyncio
+import atexit
 import time
-import json
 from datetime import datetime
+
+IMPORT_STARTED = time.perf_counter()  # Start of the cold start report, see create_app()
+
 from dotenv import load_dotenv
-from flask import Flask, request, Response
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
+    CallbackQueryHandler,
     filters,
     ContextTypes,
 )
 from telegram.constants import ChatAction
-from mistralai import Mistral
+from llm import InferencePool
+from resilience import ResilientInference
+from routing import ModelRouter
+from streaming import StreamingReply, split_message
+from sessions import SessionStore
+from repository import UserRepository, AsyncUserRepository
+from storage import open_history_store
+from registry import UserRegistry, PhoneTaken, AlreadyRegistered
+from updates import PerChatUpdateProcessor
+from shared_state import SqliteUserRegistry, SqlitePersistence, SharedConversationHandler, conversation_refresher
+from context_window import ContextBuilder
+from cache import ResponseCache
+from intents import IntentRouter
+from ratelimit import AdmissionController, RateLimited
+from coalesce import MessageCoalescer
+from outbox import Outbox
+from export import parse_user_numbers
+from durable import GroupCommitter
+import metrics
 
 # Setup logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger().addHandler(metrics.ErrorCounter())
 
 # Load environment variables
 load_dotenv()
@@ -30,45 +53,105 @@ MISTRAL_API_KEY = os.environ.get("MISTRAL_API_KEY")
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "tnixai2025")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
 PORT = int(os.environ.get("PORT", 8443))
-
-# Check for missing environment variables
-missing_vars = []
-if not MISTRAL_API_KEY:
-    missing_vars.append("MISTRAL_API_KEY")
-if not TELEGRAM_BOT_TOKEN:
-    missing_vars.append("TELEGRAM_BOT_TOKEN")
-if not WEBHOOK_URL:
-    missing_vars.append("WEBHOOK_URL")
-
-if missing_vars:
-    error_msg = f"Missing environment variables: {', '.join(missing_vars)}"
-    logger.error(error_msg)
-    raise ValueError(error_msg)
+BOT_MODE = os.environ.get("BOT_MODE", "webhook")  # "webhook" or "polling" for local testing
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))  # Across chats; each chat's updates run in order
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 60))
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 1000))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", 2.0))
+SESSION_HISTORY_TURNS = int(os.environ.get("SESSION_HISTORY_TURNS", 50))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))
+CONTEXT_SUMMARY = os.environ.get("CONTEXT_SUMMARY", "false").lower() == "true"
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "mistral-small-latest")
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1000))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_STATELESS_ONLY = os.environ.get("RESPONSE_CACHE_STATELESS_ONLY", "true").lower() == "true"
+RATE_LIMIT_USER_PER_MINUTE = float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", 10))
+RATE_LIMIT_USER_BURST = int(os.environ.get("RATE_LIMIT_USER_BURST", 5))
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_SECOND", 5))
+RATE_LIMIT_GLOBAL_BURST = int(os.environ.get("RATE_LIMIT_GLOBAL_BURST", 10))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", 50))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 30))
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0.8))
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", 4.0))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "local")  # "sqlite" shares state between worker processes
+STATE_DB = os.environ.get("STATE_DB", os.path.join("user_data", "state.db"))
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite" if STATE_BACKEND == "sqlite" else "jsonl")
+STORAGE_DB = os.environ.get("STORAGE_DB")
+HISTORY_RETENTION = int(os.environ.get("HISTORY_RETENTION", 0))  # Turns kept per user, trimmed as sessions flush; 0 keeps all
+HISTORY_FORMAT = os.environ.get("HISTORY_FORMAT", "json")  # JSONL backend: orjson, msgpack, optionally +zlib or +zstd
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 15))
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE", 10))
+FSYNC_INTERVAL = float(os.environ.get("FSYNC_INTERVAL", 1.0))  # 0 fsyncs every write immediately
+INTEGRITY_CHECK = os.environ.get("INTEGRITY_CHECK", "true").lower() == "true"
+FALLBACK_MODEL = os.environ.get("FALLBACK_MODEL", "mistral-small-latest")  # Empty disables fallback
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", 2))
+LLM_RETRY_BACKOFF = float(os.environ.get("LLM_RETRY_BACKOFF", 0.5))
+LLM_BREAKER_THRESHOLD = int(os.environ.get("LLM_BREAKER_THRESHOLD", 5))
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", 30))
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 0.95))
+LLM_SHORT_PROMPT_CHARS = int(os.environ.get("LLM_SHORT_PROMPT_CHARS", 0))  # Shorter prompts go to FALLBACK_MODEL
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "true").lower() == "true"
+MODEL_ROUTES_FILE = os.environ.get("MODEL_ROUTES_FILE")  # JSON rule table, defaults to routing.DEFAULT_ROUTES
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 25))  # Telegram allows about 30 messages/s per bot
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_SEND_RETRIES = int(os.environ.get("TELEGRAM_SEND_RETRIES", 3))
 
 # Admin user ID
 ADMIN_USER_ID = "5842560424"
 
-# Mistral AI client
+# Mistral AI client, created on the first LLM request
 MODEL = "mistral-large-latest"
-try:
-    mistral_client = Mistral(api_key=MISTRAL_API_KEY)
-    logger.info("Mistral AI client initialized")
-except Exception as e:
-    logger.error(f"Failed to initialize Mistral client: {str(e)}")
-    raise
+
+def create_mistral_client():
+    # Imported here: the SDK takes longer to import than the rest of the bot
+    from mistralai import Mistral
+    try:
+        client = Mistral(api_key=MISTRAL_API_KEY)
+        logger.info(f"Mistral AI client initialized (max {LLM_MAX_CONCURRENCY} concurrent requests, {LLM_TIMEOUT}s timeout)")
+        return client
+    except Exception as e:
+        logger.error(f"Failed to initialize Mistral client: {str(e)}")
+        raise
+
+inference_pool = InferencePool(
+    None, MODEL, max_concurrency=LLM_MAX_CONCURRENCY, timeout=LLM_TIMEOUT, client_factory=create_mistral_client
+)
+
+# Retries, circuit breaking, hedging and fallback to a faster model around the pool
+llm_client = ResilientInference(
+    inference_pool,
+    fallback_model=FALLBACK_MODEL or None,
+    retries=LLM_RETRIES,
+    backoff=LLM_RETRY_BACKOFF,
+    breaker_threshold=LLM_BREAKER_THRESHOLD,
+    breaker_reset=LLM_BREAKER_RESET,
+    hedge=LLM_HEDGE,
+    hedge_percentile=LLM_HEDGE_PERCENTILE,
+    short_prompt_chars=LLM_SHORT_PROMPT_CHARS
+)
 
 # User data directory
 USER_DATA_DIR = "user_data"
-if not os.path.exists(USER_DATA_DIR):
-    os.makedirs(USER_DATA_DIR)
 
-# User index file
+# User index file (Telegram ID -> user number and phone number)
 USER_INDEX_FILE = "user_index.json"
-user_index = {}
-if os.path.exists(USER_INDEX_FILE):
-    with open(USER_INDEX_FILE, 'r') as f:
-        user_index = json.load(f)
+
+# Storage and the user index are opened by create_app()
+storage_committer = None
+history_store = None
+session_store = None
+user_index = None
+user_repository = None  # AsyncUserRepository over user_index and history_store; handlers never touch those directly
+state_persistence = None
 
 # System prompt
 SYSTEM_PROMPT = (
@@ -77,320 +160,584 @@ SYSTEM_PROMPT = (
     "Keep responses relevant and engaging."
 )
 
+SUMMARY_PROMPT = (
+    "Update the running summary of a chat between a user and TaniGPT with the new turns below. "
+    "Keep names, facts about the user and open questions. Reply with the summary only, under 120 words."
+)
+
+async def summarize_turns(previous_summary, turns):
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    if previous_summary:
+        transcript = f"Current summary: {previous_summary}\n\nNew turns:\n{transcript}"
+    return await llm_client.complete(
+        [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+        model=SUMMARY_MODEL
+    )
+
+# Sends trivial chat to a smaller model tier; everything else goes to the default tier
+if MODEL_ROUTES_FILE:
+    model_router = ModelRouter.from_file(MODEL_ROUTES_FILE, enabled=MODEL_ROUTING)
+else:
+    model_router = ModelRouter(enabled=MODEL_ROUTING)
+
+# Keeps the system prompt pinned and the newest turns within the token budget
+context_builder = ContextBuilder(
+    SYSTEM_PROMPT,
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    summarizer=summarize_turns if CONTEXT_SUMMARY else None
+)
+
+# Cache for repeated prompts like "hi" or "who are you"
+response_cache = ResponseCache(
+    enabled=RESPONSE_CACHE,
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    stateless_only=RESPONSE_CACHE_STATELESS_ONLY
+)
+
+# Per-user and global limits on LLM requests, with a bounded wait queue
+admission_controller = AdmissionController(
+    user_rate=RATE_LIMIT_USER_PER_MINUTE / 60,
+    user_burst=RATE_LIMIT_USER_BURST,
+    global_rate=RATE_LIMIT_GLOBAL_PER_SECOND,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    max_queue=LLM_QUEUE_SIZE,
+    queue_timeout=LLM_QUEUE_TIMEOUT
+)
+
+# Rapid-fire messages from one chat are answered as a single turn
+message_coalescer = MessageCoalescer(window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT)
+
+# Replies are queued per chat and sent in the background within Telegram's rate limits
+outbox = Outbox(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_SEND_RETRIES
+)
+
+def reply(update: Update, text, **kwargs):
+    # Returns a future for the last sent message; handlers only await it when they need to
+    return outbox.reply(update.message, text, **kwargs)
+
+# Metrics read from the components above whenever a snapshot is taken
+metrics.gauge("tanigpt_llm_in_flight", "Mistral AI requests currently running", function=lambda: inference_pool.in_flight)
+metrics.counter(
+    "tanigpt_llm_cost_total", "Estimated Mistral AI spend in USD by model tier", ("tier",), function=model_router.costs
+)
+metrics.gauge(
+    "tanigpt_llm_breaker_open", "1 while a model's circuit breaker is open", ("model",),
+    function=lambda: {(model,): int(breaker.is_open()) for model, breaker in llm_client.breakers.items()}
+)
+metrics.gauge("tanigpt_llm_queue_waiting", "LLM requests waiting for admission", function=lambda: admission_controller.waiting)
+metrics.counter(
+    "tanigpt_llm_rejected_total", "LLM requests rejected by rate limiting", ("reason",),
+    function=lambda: {(reason,): count for reason, count in admission_controller.rejected.items()}
+)
+metrics.counter(
+    "tanigpt_response_cache_total", "Response cache lookups", ("result",),
+    function=lambda: {('hit',): response_cache.hits, ('miss',): response_cache.misses}
+)
+metrics.gauge("tanigpt_outbox_pending", "Telegram sends waiting in the outbox", function=lambda: outbox.pending())
+metrics.gauge("tanigpt_sessions_cached", "User sessions held in memory", function=lambda: len(session_store.sessions))
+metrics.gauge(
+    "tanigpt_sessions_pending", "Users with history changes waiting to be flushed", function=lambda: len(session_store.pending)
+)
+metrics.counter("tanigpt_fsync_commits_total", "Group commits of written files", function=lambda: storage_committer.commits)
+metrics.counter("tanigpt_fsync_files_total", "Files and directories fsynced", function=lambda: storage_committer.synced)
+COLD_START_SECONDS = metrics.gauge(
+    "tanigpt_cold_start_seconds", "Time spent importing the bot and in create_app()", ("phase",)
+)
+metrics_exporter = None
+
 # Signup states
 NAME, PHONE, CONFIRM = range(3)
 
 # Admin panel states
-PASSWORD, MENU, VIEW_HISTORY, DELETE_USER = range(4)
+PASSWORD, MENU, VIEW_HISTORY, DELETE_USER, SEARCH, EXPORT = range(6)
+ADMIN_KEYBOARD = [["Users", "History"], ["Search", "Export"], ["Delete User", "Exit"]]
+# Sent once at login and kept open, instead of being re-sent after every action
+ADMIN_MENU = ReplyKeyboardMarkup(ADMIN_KEYBOARD, resize_keyboard=True, is_persistent=True)
+
+# Bots can't upload files larger than this
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
 
 # Emoji selection
-def get_emoji(context_type, message_content=""):
-    emoji_map = {
-        "welcome": "🚀",
-        "error": "😅",
-        "admin": "🔐",
-        "success": "✅",
-        "general": "😊",
-        "date": "📅",
-        "tanishk": "🎵"
-    }
-    if context_type == "general" and "date" in message_content.lower():
-        return emoji_map["date"]
-    if context_type == "general" and "tanishk sharma" in message_content.lower():
-        return emoji_map["tanishk"]
-    return emoji_map.get(context_type, "😊")
+EMOJI_MAP = {
+    "welcome": "🚀",
+    "error": "😅",
+    "admin": "🔐",
+    "success": "✅",
+    "general": "😊",
+    "date": "📅",
+    "tanishk": "🎵"
+}
+
+# Canned answers served without calling the LLM; earlier registrations win
+intent_router = IntentRouter()
+
+@intent_router.intent("date", keywords=["date", "today", "current date", "what's the date", "aaj ka din"], emoji=EMOJI_MAP["date"])
+def answer_date(message):
+    return datetime.now().strftime("Today is %A, %B %d, %Y")
+
+@intent_router.intent("tanishk", keywords=["tanishk sharma", "who is tanishk"], emoji=EMOJI_MAP["tanishk"])
+def answer_tanishk(message):
+    return (
+        "Tanishk Sharma is the Founder of Tnix AI. He is a music producer, casting director, singer, and writer. "
+        "His songs include 'Lost in My Feeling', '06 October Forever and Always', and 'WQAT'."
+    )
 
-# Flask app for webhook
-flask_app = Flask(__name__)
+intent_router.compile()
+
+def get_emoji(context_type):
+    return EMOJI_MAP.get(context_type, "😊")
 
 # Telegram bot handlers
+@metrics.instrument
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     logger.info(f"Received /start command from user {user_id}")
 
-    if user_id in user_index:
-        user_number = user_index[user_id]['user_number']
-        await update.message.reply_text(
+    user_number = await user_repository.lookup(user_id)
+    if user_number is not None and not await user_repository.exists(user_number):
+        # A signup that stopped between the index entry and the profile; start it over
+        logger.warning(f"User {user_id} has index entry {user_number} but no profile, removing it")
+        await user_repository.delete_user(user_number)
+        user_number = None
+    if user_number is not None:
+        reply(
+            update,
             f"Welcome back to TaniGPT! Your user number is {user_number}. Kya baat karna hai? {get_emoji('welcome')}"
         )
         return ConversationHandler.END
 
-    await update.message.reply_text(
+    reply(
+        update,
         f"Yo, swagat hai TaniGPT mein! {get_emoji('welcome')} "
         "Chalo signup karte hain. Apna naam bhejo (sirf letters allowed)!"
     )
     return NAME
 
+@metrics.instrument
 async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     name = update.message.text.strip()
     logger.info(f"Received name from user {user_id}: {name}")
 
     if not re.match(r"^[A-Za-z\s]+$", name):
-        await update.message.reply_text(
+        reply(
+            update,
             f"Arre, naam mein sirf letters aur spaces hone chahiye! {get_emoji('error')} Try again!"
         )
         return NAME
 
     context.user_data['name'] = name
-    await update.message.reply_text(
+    reply(
+        update,
         f"Badhiya naam, {name}! {get_emoji('welcome')} "
         "Ab apna 10-digit phone number bhejo (like 9876543210)."
     )
     return PHONE
 
+@metrics.instrument
 async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     phone = update.message.text.strip()
     logger.info(f"Received phone from user {user_id}: {phone}")
 
     if not re.match(r"^\d{10}$", phone):
-        await update.message.reply_text(
+        reply(
+            update,
             f"Phone number 10 digits ka hona chahiye, no spaces ya symbols! {get_emoji('error')} Try again."
         )
         return PHONE
 
     formatted_phone = f"+91{phone}"
-    for uid, data in user_index.items():
-        user_file = os.path.join(USER_DATA_DIR, f"user_{data['user_number']}.json")
-        try:
-            with open(user_file, 'r') as f:
-                user_data = json.load(f)
-            if user_data['phone_number'] == formatted_phone:
-                await update.message.reply_text(
-                    f"Yeh number (+91{phone}) already registered hai! {get_emoji('error')} Naya number daal."
-                )
-                return PHONE
-        except Exception as e:
-            logger.error(f"Error reading user file {user_file}: {str(e)}")
-            continue
+    if await user_repository.find_by_phone(formatted_phone):
+        reply(
+            update,
+            f"Yeh number (+91{phone}) already registered hai! {get_emoji('error')} Naya number daal."
+        )
+        return PHONE
 
     context.user_data['phone'] = formatted_phone
     keyboard = [["Confirm"], ["Edit"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    await update.message.reply_text(
+    reply(
+        update,
         f"Details:\nName: {context.user_data['name']}\nPhone: {formatted_phone}\n"
         f"Theek hai? Confirm karo ya edit! {get_emoji('general')}",
         reply_markup=reply_markup
     )
     return CONFIRM
 
+@metrics.instrument
 async def confirm_signup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     choice = update.message.text.strip().lower()
     logger.info(f"Received signup confirmation choice from user {user_id}: {choice}")
 
     if choice == "edit":
-        await update.message.reply_text(
+        reply(
+            update,
             f"Chalo, naam se shuru karte hain! Naya naam bhejo. {get_emoji('general')}",
             reply_markup=ReplyKeyboardRemove()
         )
         return NAME
 
     if choice != "confirm":
-        await update.message.reply_text(
+        reply(
+            update,
             f"Arre, Confirm ya Edit select karo! {get_emoji('error')}",
             reply_markup=ReplyKeyboardMarkup([["Confirm"], ["Edit"]], one_time_keyboard=True, resize_keyboard=True)
         )
         return CONFIRM
 
-    user_number = str(len(user_index) + 1)
-    user_index[user_id] = {'user_number': user_number}
+    # Someone else may have claimed the number since get_phone checked it
+    if await user_repository.find_by_phone(context.user_data['phone']):
+        reply(
+            update,
+            f"Yeh number abhi abhi kisi aur ne register kar liya! {get_emoji('error')} /start se naya number daal.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
+
+    user_number = await user_repository.allocate_number()
 
     user_data = {
         'name': context.user_data['name'],
         'phone_number': context.user_data['phone'],
         'chat_history': [{"role": "system", "content": SYSTEM_PROMPT}]
     }
-    user_file = os.path.join(USER_DATA_DIR, f"user_{user_number}.json")
     try:
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-        with open(USER_INDEX_FILE, 'w') as f:
-            json.dump(user_index, f, indent=4)
+        # The index entry goes first: it claims the phone number, so a crash before the profile is
+        # written leaves an entry that /start clears instead of a profile whose number is still free
+        await user_repository.register(user_id, user_number, user_data['phone_number'])
+        await session_store.create(user_number, user_data, telegram_id=user_id)
         logger.info(f"User {user_id} signed up with user number {user_number}: {user_data}")
+    except PhoneTaken:
+        # Lost a race with a signup on another worker
+        reply(
+            update,
+            f"Yeh number abhi abhi kisi aur ne register kar liya! {get_emoji('error')} /start se naya number daal.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
+    except AlreadyRegistered as e:
+        # The same user finished a signup on another worker
+        reply(
+            update,
+            f"Tum already registered ho! Your user number is {e.user_number}. Kya baat karna hai? {get_emoji('welcome')}",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error saving user data for {user_id}: {str(e)}")
-        await update.message.reply_text(
+        try:
+            await user_repository.delete_user(user_number)  # Frees the phone number again
+        except Exception as e:
+            logger.error(f"Error undoing the signup of user {user_id}: {str(e)}")
+        reply(
+            update,
             f"Kuch galat ho gaya signup ke time pe! {get_emoji('error')} Try again with /start."
         )
         return ConversationHandler.END
 
-    await update.message.reply_text(
+    reply(
+        update,
         f"Signup done! TaniGPT mein welcome, your user number is {user_number}. Ab kya scene hai? {get_emoji('welcome')}",
         reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
+@metrics.instrument
 async def cancel_signup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    reply(
+        update,
         f"Signup cancel kiya! {get_emoji('success')} /start se dobara try kar."
     )
     return ConversationHandler.END
 
+@metrics.instrument
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     logger.info(f"Received /admin command from user {user_id}")
 
     if user_id != ADMIN_USER_ID:
-        await update.message.reply_text(
+        reply(
+            update,
             f"Sorry, admin access sirf boss ke liye! {get_emoji('admin')}"
         )
         return ConversationHandler.END
 
-    await update.message.reply_text(f"Admin password daal do! {get_emoji('admin')}")
+    reply(update, f"Admin password daal do! {get_emoji('admin')}")
     return PASSWORD
 
+@metrics.instrument
 async def check_admin_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     password = update.message.text.strip()
     logger.info(f"Received password attempt from user {user_id}")
 
     if password != ADMIN_PASSWORD:
-        await update.message.reply_text(
+        reply(
+            update,
             f"Galat password! {get_emoji('error')} Try again ya /cancel kar."
         )
         return PASSWORD
 
-    keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    await update.message.reply_text(
-        f"TaniGPT Admin Panel mein welcome! Kya karna hai? {get_emoji('admin')}",
-        reply_markup=reply_markup
-    )
+    context.user_data['admin'] = True  # Lets the page buttons work while the panel is open
+
+    reply(update, f"TaniGPT Admin Panel mein welcome! Kya karna hai? {get_emoji('admin')}", reply_markup=ADMIN_MENU)
     return MENU
 
+def page_buttons(prefix, first, last, has_prev, has_next, prev_label="Prev", next_label="Next"):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(f"⬅️ {prev_label}", callback_data=f"{prefix}:b:{first}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(f"{next_label} ➡️", callback_data=f"{prefix}:a:{last}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def show_page(update: Update, text, reply_markup):
+    # A page button edits its own message in place, unless the page needs more than one message
+    query = update.callback_query
+    if query is None:
+        reply(update, text, reply_markup=reply_markup)
+        return
+    await query.answer()
+    chat_id = query.message.chat_id
+    if len(split_message(text)) == 1:
+        outbox.submit(chat_id, lambda: query.edit_message_text(text, reply_markup=reply_markup))
+        return
+    outbox.submit(chat_id, lambda: query.edit_message_reply_markup(None))
+    outbox.reply(query.message, text, reply_markup=reply_markup)
+
+async def send_users_page(update: Update, after=None, before=None):
+    # Message counts and last activity lag by at most one session flush
+    rows, more = await user_repository.list_users(after=after, before=before, limit=ADMIN_PAGE_SIZE)
+    if not rows:
+        await show_page(update, f"Koi users nahi hain! {get_emoji('error')}", None)
+        return
+    total = await user_repository.count_users()
+    user_list = f"Registered Users ({total}):\n\n"
+    for row in rows:
+        last_active = datetime.fromtimestamp(row['last_active']).strftime('%Y-%m-%d %H:%M') if row['last_active'] else "never"
+        user_list += (
+            f"User Number: {row['user_number']}\n"
+            f"Telegram ID: {row['telegram_id'] or 'N/A'}\n"
+            f"Name: {row['name']}\n"
+            f"Phone: {row['phone_number']}\n"
+            f"Messages: {row['message_count']}, last active: {last_active}\n\n"
+        )
+    # `more` only covers the direction we moved in; the page we came from is always there
+    has_prev = more if before is not None else after is not None
+    has_next = more if before is None else True
+    await show_page(update, user_list, page_buttons("users", rows[0]['user_number'], rows[-1]['user_number'], has_prev, has_next))
+
+async def send_history_page(update: Update, user_number, after=None, before=None):
+    # Starts from the newest messages
+    await session_store.flush()
+    entries, more = await user_repository.history_page(user_number, after=after, before=before, limit=ADMIN_PAGE_SIZE)
+    if not entries:
+        await show_page(update, f"User {user_number} ka koi history nahi! {get_emoji('error')}", None)
+        return
+    profile = await session_store.profile(user_number)
+    history_text = f"Chat History for User {user_number} ({profile['name']}):\n\n"
+    for _, msg in entries:
+        role = "User" if msg['role'] == 'user' else "TaniGPT"
+        content = msg['content'].replace('\n', ' ')  # Avoid formatting issues in Telegram
+        history_text += f"{role}: {content}\n\n"
+    has_older = more if after is None else True
+    has_newer = more if after is not None else before is not None
+    await show_page(update, history_text, page_buttons(
+        f"hist:{user_number}", entries[0][0], entries[-1][0], has_older, has_newer, "Older", "Newer"
+    ))
+
+async def send_search_page(update: Update, text, after=None, before=None):
+    # Newest matches first, like history pages
+    await session_store.flush()
+    entries, more = await user_repository.search(text, after=after, before=before, limit=ADMIN_PAGE_SIZE)
+    if not entries:
+        await show_page(update, f"'{text}' kahin nahi mila! {get_emoji('error')}", None)
+        return
+    results = f"Search results for '{text}':\n\n"
+    for _, hit in entries:
+        role = "User" if hit['role'] == 'user' else "TaniGPT"
+        when = datetime.fromtimestamp(hit['ts']).strftime('%Y-%m-%d %H:%M') if hit['ts'] else "unknown"
+        snippet = hit['snippet'].replace('\n', ' ')
+        results += f"User {hit['user_number']} ({role}, {when}): {snippet}\n\n"
+    has_older = more if after is None else True
+    has_newer = more if after is not None else before is not None
+    await show_page(update, results, page_buttons(
+        "find", entries[0][0], entries[-1][0], has_older, has_newer, "Older", "Newer"
+    ))
+
+@metrics.instrument
+async def admin_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if str(query.from_user.id) != ADMIN_USER_ID or not context.user_data.get('admin'):
+        await query.answer("Admin panel band hai, /admin se login karo!", show_alert=True)
+        return
+
+    parts = query.data.split(':')
+    cursor = {'after' if parts[-2] == 'a' else 'before': int(parts[-1])}
+    try:
+        if parts[0] == 'users':
+            await send_users_page(update, **cursor)
+        elif parts[0] == 'find':
+            # The query is kept in user_data; callback data is limited to 64 bytes
+            search_query = context.user_data.get('search_query')
+            if not search_query:
+                await query.answer("Search dobara karo!", show_alert=True)
+                return
+            await send_search_page(update, search_query, **cursor)
+        else:
+            await send_history_page(update, parts[1], **cursor)
+    except Exception as e:
+        logger.error(f"Error loading admin page {query.data}: {str(e)}")
+        await query.answer(f"Error loading page! {get_emoji('error')}", show_alert=True)
+
+@metrics.instrument
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     choice = update.message.text.strip()
     logger.info(f"Admin menu choice from user {user_id}: {choice}")
 
     if choice == "Exit":
-        await update.message.reply_text(
+        context.user_data.pop('admin', None)
+        reply(
+            update,
             f"Admin panel se exit kiya! {get_emoji('success')}",
             reply_markup=ReplyKeyboardRemove()
         )
         return ConversationHandler.END
 
     elif choice == "Users":
-        if not user_index:
-            await update.message.reply_text(f"Koi users nahi hain! {get_emoji('error')}")
-        else:
-            user_list = "Registered Users:\n"
-            for uid, data in user_index.items():
-                user_file = os.path.join(USER_DATA_DIR, f"user_{data['user_number']}.json")
-                try:
-                    with open(user_file, 'r') as f:
-                        user_data = json.load(f)
-                    user_list += (
-                        f"User Number: {data['user_number']}\n"
-                        f"Telegram ID: {uid}\n"
-                        f"Name: {user_data['name']}\n"
-                        f"Phone: {user_data['phone_number']}\n\n"
-                    )
-                except Exception as e:
-                    logger.error(f"Error reading user file {user_file}: {str(e)}")
-                    user_list += f"User Number: {data['user_number']} - Error loading data\n\n"
-            await update.message.reply_text(user_list)
+        try:
+            await send_users_page(update)
+        except Exception as e:
+            logger.error(f"Error listing users: {str(e)}")
+            reply(update, f"Error loading users! {get_emoji('error')}")
 
     elif choice == "History":
-        await update.message.reply_text(f"Kis user ka history? User number daal: {get_emoji('admin')}")
+        reply(update, f"Kis user ka history? User number daal: {get_emoji('admin')}")
         return VIEW_HISTORY
 
+    elif choice == "Search":
+        reply(update, f"Kya dhundhna hai? Words daal: {get_emoji('admin')}")
+        return SEARCH
+
+    elif choice == "Export":
+        reply(
+            update,
+            f"Kin users ka export? User numbers daal (jaise 12, 15) ya 'all'. CSV chahiye to end mein 'csv' likh do. {get_emoji('admin')}"
+        )
+        return EXPORT
+
     elif choice == "Delete User":
-        await update.message.reply_text(f"Kis user ko delete? User number daal: {get_emoji('admin')}")
+        reply(update, f"Kis user ko delete? User number daal: {get_emoji('admin')}")
         return DELETE_USER
 
-    keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
+    else:
+        reply(update, f"Menu se choose karo! {get_emoji('admin')}", reply_markup=ADMIN_MENU)
     return MENU
 
+@metrics.instrument
 async def view_user_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     user_number = update.message.text.strip()
     logger.info(f"Received user number {user_number} for history from user {user_id}")
 
-    user_file = os.path.join(USER_DATA_DIR, f"user_{user_number}.json")
-    if not os.path.exists(user_file):
-        await update.message.reply_text(f"Galat user number! {get_emoji('error')}")
-        keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
+    if not await session_store.exists(user_number):
+        reply(update, f"Galat user number! {get_emoji('error')}")
         return MENU
 
     try:
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
+        await send_history_page(update, user_number)
     except Exception as e:
-        logger.error(f"Error reading user file {user_file}: {str(e)}")
-        await update.message.reply_text(f"Error loading history! {get_emoji('error')}")
-        keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
-        return MENU
+        logger.error(f"Error reading history of user {user_number}: {str(e)}")
+        reply(update, f"Error loading history! {get_emoji('error')}")
 
-    history = user_data.get('chat_history', [])
-    if len(history) <= 1:  # Only system prompt
-        await update.message.reply_text(f"User {user_number} ka koi history nahi! {get_emoji('error')}")
-    else:
-        history_text = f"Chat History for User {user_number} ({user_data['name']}):\n\n"
-        for msg in history:
-            if msg['role'] == 'system':
-                continue
-            role = "User" if msg['role'] == 'user' else "TaniGPT"
-            content = msg['content'].replace('\n', ' ')  # Avoid formatting issues in Telegram
-            history_text += f"{role}: {content}\n\n"
-        # Split long messages to avoid Telegram's 4096 character limit
-        if len(history_text) > 4096:
-            parts = [history_text[i:i + 4096] for i in range(0, len(history_text), 4096)]
-            for part in parts:
-                await update.message.reply_text(part)
+    return MENU
+
+@metrics.instrument
+async def search_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.message.from_user.id)
+    search_query = update.message.text.strip()
+    logger.info(f"Received history search from user {user_id}: {search_query}")
+
+    context.user_data['search_query'] = search_query
+    try:
+        await send_search_page(update, search_query)
+    except Exception as e:
+        logger.error(f"Error searching history for '{search_query}': {str(e)}")
+        reply(update, f"Error searching history! {get_emoji('error')}")
+
+    return MENU
+
+@metrics.instrument
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.message.from_user.id)
+    words = update.message.text.strip().split()
+    logger.info(f"Received history export request from user {user_id}: {' '.join(words)}")
+
+    fmt = "jsonl"
+    if words and words[-1].lower() in ("csv", "jsonl"):
+        fmt = words.pop().lower()
+    try:
+        user_numbers = parse_user_numbers(" ".join(words))
+        await session_store.flush()
+        count, data = await user_repository.export(user_numbers, fmt, max_bytes=EXPORT_MAX_BYTES)
+        if data is None:
+            reply(
+                update,
+                f"Export 50 MB se bada hai, Telegram pe nahi bhej sakte. Web dashboard se download karo! {get_emoji('error')}"
+            )
         else:
-            await update.message.reply_text(history_text)
+            outbox.submit(update.message.chat_id, lambda: update.message.reply_document(
+                data, filename=f"tanigpt-export.{fmt}", caption=f"{count} messages exported! {get_emoji('success')}"
+            ))
+    except ValueError:
+        reply(update, f"Galat user numbers! {get_emoji('error')}")
+    except Exception as e:
+        logger.error(f"Error exporting history: {str(e)}")
+        reply(update, f"Error exporting history! {get_emoji('error')}")
 
-    keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
     return MENU
 
+@metrics.instrument
 async def delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     user_number = update.message.text.strip()
     logger.info(f"Received user number {user_number} for deletion from user {user_id}")
 
-    user_file = os.path.join(USER_DATA_DIR, f"user_{user_number}.json")
-    if not os.path.exists(user_file):
-        await update.message.reply_text(f"Galat user number! {get_emoji('error')}")
-        keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
+    if not await session_store.exists(user_number):
+        reply(update, f"Galat user number! {get_emoji('error')}")
         return MENU
 
     try:
-        user_id_to_delete = next((uid for uid, data in user_index.items() if data['user_number'] == user_number), None)
-        if user_id_to_delete:
-            del user_index[user_id_to_delete]
-            with open(USER_INDEX_FILE, 'w') as f:
-                json.dump(user_index, f, indent=4)
-        os.remove(user_file)
-        await update.message.reply_text(f"User {user_number} deleted! {get_emoji('success')}")
+        async with session_store.lock(user_number):
+            session_store.discard(user_number)
+            await user_repository.delete_user(user_number)
+        reply(update, f"User {user_number} deleted! {get_emoji('success')}")
     except Exception as e:
         logger.error(f"Error deleting user {user_number}: {str(e)}")
-        await update.message.reply_text(f"Error deleting user! {get_emoji('error')}")
+        reply(update, f"Error deleting user! {get_emoji('error')}")
 
-    keyboard = [["Users", "History"], ["Delete User", "Exit"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    await update.message.reply_text(f"Ab kya karna hai? {get_emoji('admin')}", reply_markup=reply_markup)
     return MENU
 
+@metrics.instrument
 async def cancel_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    context.user_data.pop('admin', None)
+    reply(
+        update,
         f"Admin panel se exit kiya! {get_emoji('success')}",
         reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
+@metrics.instrument
 async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     about_text = (
         "Welcome to *TaniGPT*, a sophisticated AI-powered chatbot crafted by *Tnix AI* for Telegram. "
@@ -398,149 +745,342 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Communicating in English with a professional yet approachable tone, it leverages cutting-edge natural language processing to ensure precise, meaningful dialogue. "
         "TaniGPT embodies Tnix AI’s commitment to innovation, serving as a reliable digital companion that enhances user interaction within Telegram’s dynamic ecosystem."
     )
-    await update.message.reply_text(about_text, parse_mode="Markdown")
+    reply(update, about_text, parse_mode="Markdown")
 
+@metrics.instrument
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     logger.info(f"Clearing history for user {user_id}")
 
-    if user_id not in user_index:
-        await update.message.reply_text(f"Pehle signup kar! {get_emoji('error')} Use /start.")
+    user_number = await user_repository.lookup(user_id)
+    if user_number is None:
+        reply(update, f"Pehle signup kar! {get_emoji('error')} Use /start.")
         return
 
-    user_number = user_index[user_id]['user_number']
-    user_file = os.path.join(USER_DATA_DIR, f"user_{user_number}.json")
     try:
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
-        user_data['chat_history'] = [{"role": "system", "content": SYSTEM_PROMPT}]
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-        await update.message.reply_text(f"History cleared! {get_emoji('success')}")
+        async with session_store.lock(user_number):
+            user_data = await session_store.get(user_number)
+            await context_builder.forget(user_data)
+            session_store.reset(user_number, [{"role": "system", "content": SYSTEM_PROMPT}])
+        reply(update, f"History cleared! {get_emoji('success')}")
     except Exception as e:
         logger.error(f"Error clearing history for user {user_id}: {str(e)}")
-        await update.message.reply_text(f"Error clearing history! {get_emoji('error')}")
+        reply(update, f"Error clearing history! {get_emoji('error')}")
 
+@metrics.instrument
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     user_message = update.message.text.lower().strip()
     logger.info(f"Received text from user {user_id}: {user_message}")
 
-    if user_id not in user_index:
-        await update.message.reply_text(f"Pehle signup kar! {get_emoji('error')} Use /start.")
+    user_number = await user_repository.lookup(user_id)
+    if user_number is None:
+        reply(update, f"Pehle signup kar! {get_emoji('error')} Use /start.")
         return
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    # Best effort: not awaited, and not retried under flood control; a failure is only logged
+    chat_id = update.effective_chat.id
+    outbox.submit(
+        chat_id, lambda: context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING), retry_flood=False
+    )
 
-    user_number = user_index[user_id]['user_number']
-    user_file = os.path.join(USER_DATA_DIR, f"user_{user_number}.json")
-    try:
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
-    except Exception as e:
-        logger.error(f"Error reading user file {user_file}: {str(e)}")
-        await update.message.reply_text(f"Error loading your data! {get_emoji('error')}")
-        return
+    batch = await message_coalescer.collect(update.effective_chat.id, update.message.message_id, user_message)
+    if batch is None:
+        return  # Answered together with the earlier message it was merged into
 
-    user_data['chat_history'].append({"role": "user", "content": user_message})
+    async with session_store.lock(user_number):
+        user_message = message_coalescer.close(update.effective_chat.id, batch)
+        try:
+            user_data = await session_store.get(user_number)
+        except Exception as e:
+            logger.error(f"Error loading data for user number {user_number}: {str(e)}")
+            reply(update, f"Error loading your data! {get_emoji('error')}")
+            return
+
+        user_turn = {"role": "user", "content": user_message}
+        messages = context_builder.build(
+            user_data, user_data['chat_history'] + [user_turn],
+            on_summary=lambda summary: session_store.save_summary(user_number, summary)
+        )
 
-    MAX_HISTORY = 10
-    if len(user_data['chat_history']) > MAX_HISTORY:
-        user_data['chat_history'] = user_data['chat_history'][-MAX_HISTORY:]
+        streamed_reply = None
+        intent = intent_router.match(user_message)
+        try:
+            if intent:
+                response = intent.handler(user_message)
+                logger.info(f"Local intent '{intent.name}' matched, responding without the LLM")
+            else:
+                tier, rule = model_router.route(user_message, messages)
+                if tier is not model_router.default:
+                    logger.info(f"Routing rule '{rule}' sent the message to {tier.model}")
+                cache_key = response_cache.key_for(tier.model, messages)
+                response = response_cache.get(cache_key)
+                if response is not None:
+                    logger.info(f"Response cache hit: {response_cache.stats()}")
+                else:
+                    await admission_controller.acquire(
+                        user_id,
+                        on_queued=lambda: reply(
+                            update,
+                            f"Abhi bahut rush hai, tumhara message line mein hai. Thoda wait karo! {get_emoji('general')}"
+                        )
+                    )
+                    started = time.perf_counter()
+                    if STREAM_RESPONSES:
+                        streamed_reply = StreamingReply(update.message, edit_interval=STREAM_EDIT_INTERVAL, outbox=outbox)
+                        async for delta in llm_client.stream(messages, model=tier.model):
+                            await streamed_reply.push(delta)
+                        response = streamed_reply.full_text
+                    else:
+                        response = await llm_client.complete(messages, model=tier.model)
+                    model_router.observe(tier, time.perf_counter() - started)
+                    response_cache.put(cache_key, response)
+
+            session_store.append(user_number, user_turn, {"role": "assistant", "content": response})
+
+            emoji = intent.emoji if intent and intent.emoji else get_emoji("general")
+            if streamed_reply:
+                await streamed_reply.finish(f" {emoji}")
+            else:
+                # Long responses go out as several messages, split at paragraph or line breaks
+                reply(update, f"{response} {emoji}")
+
+        except RateLimited as e:
+            if e.reason == 'user':
+                reply(
+                    update,
+                    f"Arre thoda slow! Bahut fast messages aa rahe hain, {int(e.retry_after) + 1} second baad try karo. {get_emoji('error')}"
+                )
+            else:
+                reply(
+                    update,
+                    f"Abhi server pe bahut load hai, thodi der baad try karo! {get_emoji('error')}"
+                )
 
-    try:
-        date_keywords = ["date", "today", "current date", "what's the date", "aaj ka din"]
-        tanishk_keywords = ["tanishk sharma", "who is tanishk"]
-        if any(keyword in user_message for keyword in date_keywords):
-            current_date = datetime.now().strftime("Today is %A, %B %d, %Y")
-            response = current_date
-            logger.info(f"Date query detected, responding: {response}")
-        elif any(keyword in user_message for keyword in tanishk_keywords):
-            response = (
-                "Tanishk Sharma is the Founder of Tnix AI. He is a music producer, casting director, singer, and writer. "
-                "His songs include 'Lost in My Feeling', '06 October Forever and Always', and 'WQAT'."
+        except asyncio.TimeoutError:
+            logger.error(f"Mistral AI timed out after {LLM_TIMEOUT}s for user {user_id}")
+            reply(
+                update,
+                f"Abhi thoda zyada time lag raha hai, ek baar phir try karo! {get_emoji('error')}"
             )
-            logger.info("Tanishk Sharma query detected, responding with predefined info")
-        else:
-            start_time = time.time()
-            response = mistral_client.chat.complete(
-                model=MODEL,
-                messages=user_data['chat_history']
-            ).choices[0].message.content
-            end_time = time.time()
-            logger.info(f"Mistral AI response time: {end_time - start_time:.2f} seconds")
-
-        user_data['chat_history'].append({"role": "assistant", "content": response})
-
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-
-        emoji = get_emoji("general", user_message)
-        # Split long messages to avoid Telegram's 4096 character limit
-        if len(response) > 4096:
-            parts = [response[i:i + 4096] for i in range(0, len(response), 4096)]
-            for part in parts:
-                await update.message.reply_text(f"{part} {emoji}")
-        else:
-            await update.message.reply_text(f"{response} {emoji}")
 
-    except Exception as e:
-        logger.error(f"Error in text processing: {str(e)}")
-        emoji = get_emoji("error")
-        await update.message.reply_text(f"Kuch galat ho gaya: {str(e)} {emoji}")
+        except Exception as e:
+            # The details stay in the log; users get a plain apology
+            logger.error(f"Error in text processing for user {user_id}: {type(e).__name__}: {str(e)}")
+            emoji = get_emoji("error")
+            reply(update, f"Kuch galat ho gaya, thodi der baad phir try karo! {emoji}")
+
+async def on_startup(application: Application):
+    global metrics_exporter
+    metrics_exporter = asyncio.get_running_loop().create_task(metrics.run_exporter(METRICS_DIR, METRICS_INTERVAL))
+
+async def on_stop(application: Application):
+    # Runs after the application has finished every in-flight update, while the bot can still send
+    logger.info("Sending queued replies...")
+    await outbox.drain()
+
+async def on_shutdown(application: Application):
+    # Runs after the bot's HTTP client is closed
+    logger.info("Flushing sessions and stopping the inference pool...")
+    await session_store.close()
+    storage_committer.close()
+    inference_pool.shutdown()
+    history_store.close()
+    if metrics_exporter is not None:
+        metrics_exporter.cancel()
+        # This worker's numbers are gone with it
+        try:
+            os.remove(metrics.snapshot_path(METRICS_DIR))
+        except OSError:
+            pass
+
+def conversation_handler(name, **kwargs):
+    if state_persistence is None:
+        return ConversationHandler(**kwargs)
+    # Conversation states are shared so each step of a signup may reach a different worker
+    return SharedConversationHandler(name=name, shared_persistence=state_persistence, **kwargs)
+
+def check_config():
+    missing_vars = []
+    if not MISTRAL_API_KEY:
+        missing_vars.append("MISTRAL_API_KEY")
+    if not TELEGRAM_BOT_TOKEN:
+        missing_vars.append("TELEGRAM_BOT_TOKEN")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        missing_vars.append("WEBHOOK_URL")
+
+    if missing_vars:
+        error_msg = f"Missing environment variables: {', '.join(missing_vars)}"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+    # JSONL files are only safe to write from a single process
+    if STATE_BACKEND == "sqlite" and STORAGE_BACKEND != "sqlite":
+        error_msg = "STATE_BACKEND=sqlite requires STORAGE_BACKEND=sqlite"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+def check_user_index(registry):
+    # Runs once the JSON user index is first loaded
+    if registry.recovered:
+        # The summary index records every user's Telegram ID, so the registry can be rebuilt from it
+        entries, after = [], None
+        while True:
+            rows, more = history_store.list_users(after=after, limit=500)
+            entries += [(row['telegram_id'], row) for row in rows if row['telegram_id']]
+            if not more:
+                break
+            after = rows[-1]['user_number']
+        registry.import_users(entries)
+        logger.warning(f"Rebuilt {USER_INDEX_FILE} with {len(registry)} user(s) from the user summary index")
+    if registry.missing_phones():
+        logger.info("User index has entries without phone numbers, rebuilding phone index")
+        registry.rebuild_phones(history_store)
+
+def open_storage():
+    global storage_committer, history_store, session_store, user_index, user_repository, state_persistence
+    os.makedirs(USER_DATA_DIR, exist_ok=True)
+
+    # fsyncs of JSON files written within FSYNC_INTERVAL are batched into one group commit
+    storage_committer = GroupCommitter(FSYNC_INTERVAL)
+    atexit.register(storage_committer.close)
+
+    # Conversation storage; active users' recent history lives in memory and is written back in batches
+    history_store = open_history_store(
+        STORAGE_BACKEND, USER_DATA_DIR, db_path=STORAGE_DB, retention=HISTORY_RETENTION, committer=storage_committer,
+        history_format=HISTORY_FORMAT
+    )
+    if INTEGRITY_CHECK:
+        history_store.check_integrity()
+    session_store = SessionStore(
+        history_store,
+        max_sessions=SESSION_CACHE_SIZE,
+        flush_interval=0 if STATE_BACKEND == "sqlite" else SESSION_FLUSH_INTERVAL,
+        max_turns=SESSION_HISTORY_TURNS,
+        shared=STATE_BACKEND == "sqlite"
+    )
+    atexit.register(session_store.flush_sync)
+
+    if STATE_BACKEND == "sqlite":
+        # Shared by every worker; seeded from user_index.json the first time
+        user_index = SqliteUserRegistry(STATE_DB)
+        if not len(user_index) and os.path.exists(USER_INDEX_FILE):
+            user_index.import_users(UserRegistry(USER_INDEX_FILE).items())
+            logger.info(f"Imported {len(user_index)} user(s) from {USER_INDEX_FILE} into {STATE_DB}")
+        if user_index.missing_phones():
+            logger.info("User index has entries without phone numbers, rebuilding phone index")
+            user_index.rebuild_phones(history_store)
+        state_persistence = SqlitePersistence(STATE_DB)
+    else:
+        # Loaded on first use, from a snapshot when one is up to date
+        user_index = UserRegistry(USER_INDEX_FILE, committer=storage_committer, on_load=check_user_index)
+        state_persistence = None
+
+    # Admin views page through a per-user summary index instead of reading every profile
+    if not history_store.summaries_built():
+        logger.info("User summary index not built yet, building it")
+        history_store.rebuild_summaries({data['user_number']: uid for uid, data in user_index.items()})
+    if not history_store.search_built():
+        logger.info("Search index not built yet, building it")
+        history_store.rebuild_search()
+
+    user_repository = AsyncUserRepository(UserRepository(user_index, history_store))
+
+def build_application():
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if state_persistence is not None:
+        builder = builder.persistence(state_persistence)
+    app = builder.build()
+
+    # Signup conversation handler
+    signup_handler = conversation_handler(
+        "signup",
+        entry_points=[CommandHandler("start", start)],
+        states={
+            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
+            PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_phone)],
+            CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_signup)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_signup)],
+    )
+
+    # Admin conversation handler
+    admin_handler = conversation_handler(
+        "admin",
+        entry_points=[CommandHandler("admin", admin_panel)],
+        states={
+            PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_admin_password)],
+            MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_menu)],
+            VIEW_HISTORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_user_history)],
+            DELETE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_user)],
+            SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_history)],
+            EXPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_history)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_admin)],
+    )
 
-# Flask webhook endpoint
-@flask_app.route(f"/{TELEGRAM_BOT_TOKEN}", methods=["POST"])
-async def webhook():
-    update = Update.de_json(request.get_json(force=True), app.bot)
-    await app.process_update(update)
-    return Response(status=200)
+    # Add handlers
+    if state_persistence is not None:
+        app.add_handler(conversation_refresher([signup_handler, admin_handler]), group=-1)
+    app.add_handler(signup_handler)
+    app.add_handler(admin_handler)
+    app.add_handler(CallbackQueryHandler(admin_page, pattern=r"^(users|hist|find):"))
+    app.add_handler(CommandHandler("about", about))
+    app.add_handler(CommandHandler("clear", clear))
+    # Not blocking, so a chat's next message can reach the coalescer while this one waits for it
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text, block=False))
+    return app
+
+def create_app():
+    """Checks the configuration, opens storage and returns the Telegram application.
+
+    Importing this module only defines the handlers; everything that touches
+    the disk happens here, and the Mistral client and the JSON user index are
+    created on first use.
+    """
+    started = time.perf_counter()
+    check_config()
+    open_storage()
+    app = build_application()
+    ready = time.perf_counter()
+    COLD_START_SECONDS.set(IMPORT_SECONDS, phase='import')
+    COLD_START_SECONDS.set(ready - started, phase='create_app')
+    logger.info(f"Cold start: imported in {IMPORT_SECONDS:.3f}s, app created in {ready - started:.3f}s")
+    return app
 
 def main():
-    global app
     logger.info("Starting TaniGPT Bot...")
     try:
-        app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-        # Signup conversation handler
-        signup_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start)],
-            states={
-                NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
-                PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_phone)],
-                CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_signup)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel_signup)],
-        )
-
-        # Admin conversation handler
-        admin_handler = ConversationHandler(
-            entry_points=[CommandHandler("admin", admin_panel)],
-            states={
-                PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, check_admin_password)],
-                MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_menu)],
-                VIEW_HISTORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_user_history)],
-                DELETE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_user)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel_admin)],
-        )
+        app = create_app()
 
-        # Add handlers
-        app.add_handler(signup_handler)
-        app.add_handler(admin_handler)
-        app.add_handler(CommandHandler("about", about))
-        app.add_handler(CommandHandler("clear", clear))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-
-        # Set webhook and run Flask app
-        logger.info(f"Setting up webhook at {WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}")
-        app.bot.set_webhook(url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}")
-        flask_app.run(host="0.0.0.0", port=PORT, debug=False)
-        logger.info(f"Bot running in webhook mode on port {PORT}")
+        if BOT_MODE == "polling":
+            logger.info("Bot running in long-polling mode")
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
+        else:
+            # PTB's webhook server acknowledges each update at once and queues it for the
+            # shared event loop; SIGINT/SIGTERM drain in-flight updates before exiting
+            logger.info(f"Bot running in webhook mode on port {PORT}, webhook at {WEBHOOK_URL}/<token>")
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TELEGRAM_BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
 
     except Exception as e:
         logger.error(f"Failed to start bot: {str(e)}")
         raise
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 if __name__ == "__main__":
     main()
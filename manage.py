@@ -0,0 +1,120 @@
+import argparse
+import logging
+import os
+from dotenv import load_dotenv
+from storage import open_history_store, migrate
+from registry import UserRegistry
+from export import EXPORT_FORMATS, parse_user_numbers, write_export
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Same defaults as main.py
+USER_DATA_DIR = "user_data"
+USER_INDEX_FILE = "user_index.json"
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "local")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite" if STATE_BACKEND == "sqlite" else "jsonl")
+STORAGE_DB = os.environ.get("STORAGE_DB")
+HISTORY_RETENTION = int(os.environ.get("HISTORY_RETENTION", 0))
+HISTORY_FORMAT = os.environ.get("HISTORY_FORMAT", "json")
+
+
+def open_store(args):
+    return open_history_store(
+        args.backend, USER_DATA_DIR, db_path=args.db, retention=HISTORY_RETENTION, history_format=HISTORY_FORMAT
+    )
+
+
+def migrate_storage(args):
+    store = open_store(args)
+    try:
+        migrate(USER_INDEX_FILE, USER_DATA_DIR, store)
+    finally:
+        store.close()
+
+
+def compact_storage(args):
+    store = open_store(args)
+    try:
+        store.compact_all()
+        logger.info("Compaction finished")
+    finally:
+        store.close()
+
+
+def rebuild_phone_index(args):
+    store = open_store(args)
+    try:
+        UserRegistry(USER_INDEX_FILE).rebuild_phones(store)
+    finally:
+        store.close()
+
+
+def rebuild_user_summaries(args):
+    store = open_store(args)
+    try:
+        user_index = UserRegistry(USER_INDEX_FILE)
+        store.rebuild_summaries({data['user_number']: uid for uid, data in user_index.items()})
+    finally:
+        store.close()
+
+
+def rebuild_search_index(args):
+    store = open_store(args)
+    try:
+        store.rebuild_search()
+    finally:
+        store.close()
+
+
+def check_integrity(args):
+    store = open_store(args)
+    try:
+        problems = store.check_integrity(repair=not args.dry_run)
+        logger.info(f"Integrity check finished, {problems} problem(s) found")
+    finally:
+        store.close()
+
+
+def export_history(args):
+    store = open_store(args)
+    try:
+        write_export(store, args.output, parse_user_numbers(args.users), args.format)
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TaniGPT maintenance commands (run while the bot is stopped)")
+    parser.add_argument("--backend", default=STORAGE_BACKEND, choices=["jsonl", "sqlite"])
+    parser.add_argument("--db", default=STORAGE_DB, help="SQLite database path for the sqlite backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate-storage", help="Import user_data/*.json and user_index.json into the storage backend")
+    commands.add_parser("compact", help="Rewrite conversation logs down to their live turns, in HISTORY_FORMAT")
+    commands.add_parser("rebuild-phone-index", help="Refill phone numbers in user_index.json from the user profiles")
+    commands.add_parser("rebuild-user-summaries", help="Recount messages and last activity for the admin user list")
+    commands.add_parser("rebuild-search-index", help="Re-index every conversation for admin search")
+    check_parser = commands.add_parser("check-integrity", help="Find and repair files damaged by a crash")
+    check_parser.add_argument("--dry-run", action="store_true", help="only report problems")
+    export_parser = commands.add_parser("export", help="Write conversations to a JSONL or CSV file")
+    export_parser.add_argument("output", help="file to write")
+    export_parser.add_argument("--format", default="jsonl", choices=EXPORT_FORMATS)
+    export_parser.add_argument("--users", help="comma-separated user numbers (default: all users)")
+
+    args = parser.parse_args()
+    handlers = {
+        "migrate-storage": migrate_storage,
+        "compact": compact_storage,
+        "rebuild-phone-index": rebuild_phone_index,
+        "rebuild-user-summaries": rebuild_user_summaries,
+        "rebuild-search-index": rebuild_search_index,
+        "check-integrity": check_integrity,
+        "export": export_history,
+    }
+    handlers[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import asyncio
+import contextvars
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Name of the handler processing the current update, for labelling errors
+current_handler = contextvars.ContextVar("current_handler", default="none")
+# Futures of the sends the current handler queued, so UPDATE_SECONDS can run until they are delivered
+current_replies = contextvars.ContextVar("current_replies", default=None)
+_reply_waiters = set()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.function = function  # Reads the value(s) from elsewhere at snapshot time
+        self.values = {}
+        self.lock = threading.Lock()  # LLM and storage metrics are recorded from worker threads
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                return [[list(key), value] for key, value in self.values.items()]
+        value = self.function()
+        if isinstance(value, dict):
+            return [[list(key), v] for key, v in value.items()]
+        return [[[], value]]
+
+    def snapshot(self):
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.labels), 'samples': self.samples()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            counts['buckets'][index] += 1
+            counts['sum'] += value
+            counts['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            return [[list(key), dict(counts, buckets=list(counts['buckets']))] for key, counts in self.values.items()]
+
+    def snapshot(self):
+        return dict(super().snapshot(), buckets=list(self.buckets))
+
+
+registry = {}
+
+
+def _register(metric):
+    if metric.name in registry:
+        raise ValueError(f"Metric {metric.name} is already registered")
+    registry[metric.name] = metric
+    return metric
+
+
+def counter(name, help_text, labels=(), function=None):
+    return _register(Counter(name, help_text, labels, function))
+
+
+def gauge(name, help_text, labels=(), function=None):
+    return _register(Gauge(name, help_text, labels, function))
+
+
+def histogram(name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, labels, buckets))
+
+
+UPDATE_SECONDS = histogram(
+    "tanigpt_update_seconds", "Time from a handler receiving an update until it has replied", ("handler",)
+)
+ERRORS = counter("tanigpt_errors_total", "Errors logged while handling updates", ("handler", "source"))
+
+
+def track_reply(future):
+    # Called by the outbox for every send it queues
+    replies = current_replies.get()
+    if replies is not None:
+        replies.append(future)
+
+
+def _observe_replied(name, started, replies):
+    # Replies go out through the outbox after the handler returns; the update counts once they are delivered
+    if not replies:
+        UPDATE_SECONDS.observe(time.perf_counter() - started, handler=name)
+        return
+
+    async def wait():
+        await asyncio.wait(replies)
+        UPDATE_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    task = asyncio.get_running_loop().create_task(wait())
+    _reply_waiters.add(task)
+    task.add_done_callback(_reply_waiters.discard)
+
+
+def instrument(handler):
+    # Wraps a PTB callback to time it until its replies are sent and attribute errors logged inside it to its name
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        token = current_handler.set(name)
+        replies = []
+        replies_token = current_replies.set(replies)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            ERRORS.inc(handler=name, source='uncaught')
+            raise
+        finally:
+            current_replies.reset(replies_token)
+            current_handler.reset(token)
+            _observe_replied(name, started, replies)
+
+    return wrapper
+
+
+class ErrorCounter(logging.Handler):
+    """Counts ERROR log records by the handler they happened in and the logger that emitted them."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        ERRORS.inc(handler=current_handler.get(), source=record.name)
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in registry.items()}
+
+
+def write_snapshot(path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def snapshot_path(directory):
+    return os.path.join(directory, f"worker-{os.getpid()}.json")
+
+
+async def run_exporter(directory, interval=15.0):
+    # Every worker process writes its own file; the admin app merges them on /metrics
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory)
+    while True:
+        try:
+            await asyncio.to_thread(write_snapshot, path)
+        except Exception as e:
+            logger.error(f"Error writing metrics snapshot: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+def load_snapshots(directory, max_age=60.0):
+    # Files not refreshed within max_age belong to workers that died
+    snapshots = []
+    now = time.time()
+    for path in glob.glob(os.path.join(directory, "worker-*.json")):
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                continue
+            with open(path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading metrics snapshot {path}: {str(e)}")
+    return snapshots
+
+
+def merge(snapshots):
+    # Counters, histograms and gauges (queue depths, in-flight requests) are all summed across workers
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if metric['type'] != 'histogram':
+                    target['samples'][key] = (current or 0) + value
+                elif current is None:
+                    target['samples'][key] = dict(value, buckets=list(value['buckets']))
+                else:
+                    current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                    current['sum'] += value['sum']
+                    current['count'] += value['count']
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(snapshots):
+    # Prometheus text exposition format (version 0.0.4)
+    lines = []
+    for name, metric in sorted(merge(snapshots).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric['samples'].items()):
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_labels(metric['labels'], key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + ['+Inf'], value['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], key)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(metric['labels'], key)} {value['count']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from ratelimit import TokenBucket
+from streaming import TELEGRAM_MESSAGE_LIMIT, split_message
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SENDS = metrics.counter("tanigpt_telegram_sends_total", "Telegram API calls made by the outbox", ("result",))
+SEND_DELAY = metrics.histogram(
+    "tanigpt_telegram_send_delay_seconds", "Time sends spent queued in the outbox before going out"
+)
+
+
+class Outbox:
+    """Queues outgoing Telegram calls so handlers don't wait on the network.
+
+    Every chat has a FIFO queue drained by its own worker task, so a chat's
+    messages arrive in the order they were queued. Sends are shaped by a
+    global and a per-chat token bucket. RetryAfter pauses every worker for
+    the time Telegram asks for and the call is retried; timeouts and network
+    errors are retried with backoff up to max_retries times.
+
+    submit() returns a future for the call's result, which callers only await
+    when they need the sent message or want to know it went out. The futures
+    are also handed to metrics.track_reply(), so the handler's update time
+    runs until its replies have gone out.
+    """
+
+    def __init__(self, global_rate=25.0, chat_rate=1.0, chat_burst=3, max_retries=3, max_tracked_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.chat_buckets = {}
+        self.queues = {}
+        self.workers = {}
+        self.paused_until = 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_tracked_chats:
+                # A full bucket is indistinguishable from a fresh one, so it can go
+                self.chat_buckets = {cid: b for cid, b in self.chat_buckets.items() if not b.is_full()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def submit(self, chat_id, call, retry_flood=True):
+        # call is a zero-argument function returning the API coroutine, so retries can make a fresh one
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(_consume_exception)
+        metrics.track_reply(future)
+        self.queues.setdefault(chat_id, asyncio.Queue()).put_nowait((call, retry_flood, future, loop.time()))
+        worker = self.workers.get(chat_id)
+        if worker is None or worker.done():
+            self.workers[chat_id] = loop.create_task(self._run_chat(chat_id))
+        return future
+
+    def reply(self, message, text, limit=TELEGRAM_MESSAGE_LIMIT, **kwargs):
+        # Splits at paragraph, line or word boundaries; reply_markup and the like go with the last chunk
+        chunks = split_message(text, limit)
+        for chunk in chunks[:-1]:
+            self.submit(message.chat_id, lambda chunk=chunk: message.reply_text(chunk))
+        return self.submit(message.chat_id, lambda: message.reply_text(chunks[-1], **kwargs))
+
+    async def _run_chat(self, chat_id):
+        queue = self.queues[chat_id]
+        while not queue.empty():
+            call, retry_flood, future, queued_at = queue.get_nowait()
+            if future.cancelled():
+                continue
+            SEND_DELAY.observe(asyncio.get_running_loop().time() - queued_at)
+            try:
+                result = await self._send(chat_id, call, retry_flood)
+            except Exception as e:
+                SENDS.inc(result='failed')
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                SENDS.inc(result='sent')
+                if not future.done():
+                    future.set_result(result)
+        # Idle chats keep neither a queue nor a worker
+        if self.queues.get(chat_id) is queue and queue.empty():
+            del self.queues[chat_id]
+            self.workers.pop(chat_id, None)
+
+    async def _wait_for_token(self, bucket):
+        while not bucket.try_take():
+            await asyncio.sleep(bucket.retry_after())
+
+    async def _send(self, chat_id, call, retry_flood):
+        attempt = 0
+        while True:
+            loop = asyncio.get_running_loop()
+            if self.paused_until > loop.time():
+                await asyncio.sleep(self.paused_until - loop.time())
+            await self._wait_for_token(self._chat_bucket(chat_id))
+            await self._wait_for_token(self.global_bucket)
+            try:
+                return await call()
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                self.paused_until = max(self.paused_until, loop.time() + retry_after)
+                logger.warning(f"Telegram flood control, pausing sends for {retry_after}s")
+                SENDS.inc(result='flood_wait')
+                if not retry_flood:
+                    raise
+            except (TimedOut, NetworkError) as e:
+                # BadRequest is a NetworkError too, but retrying it can't help
+                if isinstance(e, BadRequest) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Error sending to chat {chat_id} ({str(e)}), retry {attempt}/{self.max_retries}")
+                SENDS.inc(result='retried')
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    async def drain(self, timeout=10.0):
+        # For shutdown: lets queued sends go out, up to timeout seconds
+        workers = [worker for worker in self.workers.values() if not worker.done()]
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            if pending:
+                logger.warning(f"Dropped {self.pending()} unsent message(s) at shutdown")
+                for worker in pending:
+                    worker.cancel()
+
+
+def _consume_exception(future):
+    # Failures are counted and logged by the worker; most callers never await the future
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error sending Telegram message: {str(future.exception())}")
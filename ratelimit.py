@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after=0.0):
+        super().__init__(f"Rate limited ({reason}), retry after {retry_after:.1f}s")
+        self.reason = reason  # 'user' or 'overload'
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def retry_after(self):
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """Decides whether an LLM request may start now, has to wait, or is shed.
+
+    Each user has a token bucket, and so does the whole bot. Requests that
+    find the global bucket empty wait in FIFO order in a queue of at most
+    max_queue entries. When the queue is full, or the wait exceeds
+    queue_timeout, the request is rejected with RateLimited.
+
+    acquire()'s on_queued is a plain function, called when the request starts
+    waiting. Anything it starts, like a notice to the user, runs on its own:
+    admission doesn't wait for it, and its errors are only logged.
+    """
+
+    def __init__(self, user_rate, user_burst, global_rate, global_burst, max_queue=50, queue_timeout=30.0,
+                 max_tracked_users=10000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_tracked_users = max_tracked_users
+        self.user_buckets = {}
+        self.waiting = 0
+        self._queue_lock = asyncio.Lock()
+        self.rejected = {'user': 0, 'overload': 0}
+
+    def _user_bucket(self, user_id):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            if len(self.user_buckets) >= self.max_tracked_users:
+                # A full bucket is indistinguishable from a fresh one, so it can go
+                self.user_buckets = {uid: b for uid, b in self.user_buckets.items() if not b.is_full()}
+            bucket = self.user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _reject(self, reason, retry_after=0.0):
+        self.rejected[reason] += 1
+        logger.warning(f"Rejected LLM request ({reason}), {self.waiting} waiting")
+        return RateLimited(reason, retry_after)
+
+    async def acquire(self, user_id, on_queued=None):
+        user_bucket = self._user_bucket(user_id)
+        if not user_bucket.try_take():
+            raise self._reject('user', user_bucket.retry_after())
+        if not self.waiting and self.global_bucket.try_take():
+            return
+        if self.waiting >= self.max_queue:
+            user_bucket.give_back()
+            raise self._reject('overload', self.global_bucket.retry_after())
+
+        self.waiting += 1
+        try:
+            if on_queued is not None:
+                try:
+                    on_queued()
+                except Exception as e:
+                    logger.error(f"Error notifying a queued LLM request: {str(e)}")
+            deadline = time.monotonic() + self.queue_timeout
+            async with self._queue_lock:
+                while not self.global_bucket.try_take():
+                    wait = self.global_bucket.retry_after()
+                    if time.monotonic() + wait > deadline:
+                        user_bucket.give_back()
+                        raise self._reject('overload', wait)
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
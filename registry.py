@@ -0,0 +1,206 @@
+import json
+import logging
+import marshal
+import os
+import time
+from durable import quarantine, write_json
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class PhoneTaken(Exception):
+    def __init__(self, phone_number):
+        super().__init__(f"Phone number {phone_number} is already registered")
+        self.phone_number = phone_number
+
+
+class AlreadyRegistered(Exception):
+    # The Telegram user signed up already, e.g. on another worker while this signup was running
+    def __init__(self, uid, user_number):
+        super().__init__(f"User {uid} is already registered as user number {user_number}")
+        self.uid = uid
+        self.user_number = user_number
+
+
+class UserRegistry:
+    """Telegram ID -> user entry map backed by user_index.json, with a phone number index.
+
+    Each entry carries the user's phone_number, so the phone index is rebuilt in
+    memory on load and both always change in the same atomic file replace.
+
+    Nothing is read until the registry is first used. A compact marshal
+    snapshot of the in-memory maps is kept next to the JSON file and loaded
+    instead of it while it matches the JSON file's size and mtime. An
+    unreadable JSON file is quarantined and `recovered` is set; `on_load` is
+    called once loading finishes, e.g. to refill the registry with import_users().
+    """
+
+    def __init__(self, path, committer=None, on_load=None):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.committer = committer  # Batches the directory fsync after each replace
+        self.on_load = on_load
+        self.users = None  # uid -> (user_number, phone_number)
+        self.phones = {}
+        self.last_number = 0
+        self.recovered = False
+        self.loaded = False  # Set once loading, on_load included, has finished
+
+    def _loaded(self):
+        if self.users is None:
+            self._load()
+        return self.users
+
+    def in_memory(self):
+        # True once loaded: from then on reads are plain dict lookups. Checked from
+        # other threads, so it waits for on_load as well, which may still refill the maps
+        return self.loaded
+
+    def _load(self):
+        started = time.perf_counter()
+        source = self._load_snapshot() or self._load_json()
+        if self.on_load is not None:
+            self.on_load(self)
+        self.loaded = True
+        logger.info(f"Loaded {len(self.users)} user(s) from {source} in {time.perf_counter() - started:.3f}s")
+
+    def _stat_key(self):
+        stat = os.stat(self.path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.path) or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                version, stat_key, users, phones, last_number = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable user index snapshot {self.snapshot_path}: {str(e)}")
+            return None
+        if version != SNAPSHOT_VERSION or stat_key != self._stat_key():
+            return None  # Written for an older user_index.json
+        self.users, self.phones, self.last_number = users, phones, last_number
+        return self.snapshot_path
+
+    def _load_json(self):
+        users = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    entries = json.load(f)
+                if not isinstance(entries, dict):
+                    raise ValueError("not a JSON object")
+                users = {uid: (data['user_number'], data.get('phone_number')) for uid, data in entries.items()}
+            except ValueError as e:
+                logger.error(f"User index {self.path} is unreadable: {str(e)}")
+                quarantine(self.path, "unreadable user index")
+                self.recovered = True
+        self.users = users
+        self._index()
+        if os.path.exists(self.path):
+            self._write_snapshot()
+        return self.path
+
+    def _index(self):
+        self.phones = {}
+        for uid, (_, phone_number) in self.users.items():
+            if phone_number is None:
+                continue
+            if phone_number in self.phones:
+                logger.warning(f"Phone number {phone_number} is registered to both {self.phones[phone_number]} and {uid}")
+            self.phones[phone_number] = uid
+        self.last_number = max((int(user_number) for user_number, _ in self.users.values()), default=0)
+
+    def _write_snapshot(self):
+        # A cache of user_index.json: no fsync, a torn or stale snapshot is just ignored
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                marshal.dump([SNAPSHOT_VERSION, self._stat_key(), self.users, self.phones, self.last_number], f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"Error writing user index snapshot: {str(e)}")
+
+    def save(self):
+        # Write to a temp file and rename so a crash never leaves a truncated index
+        entries = {uid: {'user_number': user_number, 'phone_number': phone_number}
+                   for uid, (user_number, phone_number) in self._loaded().items()}
+        write_json(self.path, entries, self.committer)
+        self._write_snapshot()
+
+    def __contains__(self, uid):
+        return uid in self._loaded()
+
+    def __getitem__(self, uid):
+        user_number, phone_number = self._loaded()[uid]
+        return {'user_number': user_number, 'phone_number': phone_number}
+
+    def __len__(self):
+        return len(self._loaded())
+
+    def items(self):
+        return [(uid, {'user_number': user_number, 'phone_number': phone_number})
+                for uid, (user_number, phone_number) in self._loaded().items()]
+
+    def find_by_phone(self, phone_number):
+        self._loaded()
+        return self.phones.get(phone_number)
+
+    def find_by_number(self, user_number):
+        return next((uid for uid, entry in self._loaded().items() if entry[0] == user_number), None)
+
+    def allocate_number(self):
+        # Unlike len(users) + 1, never hands out a number that is still in use after a deletion
+        self._loaded()
+        self.last_number += 1
+        return str(self.last_number)
+
+    def add(self, uid, user_number, phone_number):
+        users = self._loaded()
+        if uid in users:
+            raise AlreadyRegistered(uid, users[uid][0])
+        if phone_number in self.phones:
+            raise PhoneTaken(phone_number)
+        users[uid] = (user_number, phone_number)
+        try:
+            self.save()
+        except Exception:
+            del users[uid]
+            raise
+        self.phones[phone_number] = uid
+
+    def remove(self, uid):
+        users = self._loaded()
+        entry = users.pop(uid)
+        try:
+            self.save()
+        except Exception:
+            users[uid] = entry
+            raise
+        if self.phones.get(entry[1]) == uid:
+            del self.phones[entry[1]]
+
+    def import_users(self, entries):
+        # Existing entries win, as in SqliteUserRegistry
+        users = self._loaded()
+        for uid, data in entries:
+            users.setdefault(uid, (data['user_number'], data.get('phone_number')))
+        self._index()
+        self.save()
+
+    def missing_phones(self):
+        return [uid for uid, (_, phone_number) in self._loaded().items() if phone_number is None]
+
+    def rebuild_phones(self, history_store):
+        # Refill every entry's phone_number from the user profiles
+        users = self._loaded()
+        for uid, (user_number, phone_number) in list(users.items()):
+            try:
+                users[uid] = (user_number, history_store.load_profile(user_number)['phone_number'])
+            except Exception as e:
+                logger.error(f"Error reading profile of user {user_number}: {str(e)}")
+        self._index()
+        self.save()
+        logger.info(f"Rebuilt phone index for {len(self.phones)} user(s)")
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+from export import write_export
+from sessions import STORAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class UserRepository:
+    """The user index and the history store behind one interface.
+
+    The index maps Telegram IDs to user numbers and phone numbers; the history
+    store holds profiles and conversations. Every method blocks: the admin
+    dashboard calls them from its Flask worker threads, and the bot goes
+    through AsyncUserRepository, which runs them off the event loop.
+
+    user_index may be None when the caller can't see the bot's index (the
+    dashboard with the JSON index); lookups then find nobody.
+    """
+
+    def __init__(self, user_index, history_store):
+        self.user_index = user_index
+        self.history_store = history_store
+        self.lock = threading.Lock()  # UserRegistry isn't thread-safe
+
+    def lookup(self, telegram_id):
+        # The user number, or None if the user hasn't signed up
+        if self.user_index is None:
+            return None
+        with self.lock:
+            return self.lookup_in_memory(telegram_id)
+
+    def index_in_memory(self):
+        return self.user_index is not None and self.user_index.in_memory()
+
+    def lookup_in_memory(self, telegram_id):
+        # Needs no lock once the index is loaded: it's a single dict read, which writers can't tear
+        try:
+            return self.user_index[telegram_id]['user_number']
+        except KeyError:
+            return None
+
+    def find_by_phone(self, phone_number):
+        if self.user_index is None:
+            return None
+        with self.lock:
+            return self.user_index.find_by_phone(phone_number)
+
+    def allocate_number(self):
+        with self.lock:
+            return self.user_index.allocate_number()
+
+    def register(self, telegram_id, user_number, phone_number):
+        # Raises PhoneTaken if someone else registered the number first, AlreadyRegistered if this user did
+        with self.lock:
+            self.user_index.add(telegram_id, user_number, phone_number)
+
+    def delete_user(self, user_number):
+        # Removes the index entry and the history; returns the user's Telegram ID, if known
+        telegram_id = None
+        if self.user_index is not None:
+            with self.lock:
+                telegram_id = self.user_index.find_by_number(user_number)
+                if telegram_id:
+                    self.user_index.remove(telegram_id)
+        self.history_store.delete_user(user_number)
+        return telegram_id
+
+    def delete_by_telegram_id(self, telegram_id):
+        # Returns the deleted user's number, or None if the index doesn't know the user
+        user_number = self.lookup(telegram_id)
+        if user_number is not None:
+            self.delete_user(user_number)
+        return user_number
+
+    def exists(self, user_number):
+        return self.history_store.exists(user_number)
+
+    def profile(self, user_number):
+        return self.history_store.load_profile(user_number)
+
+    def history_page(self, user_number, after=None, before=None, limit=10):
+        return self.history_store.history_page(user_number, after, before, limit)
+
+    def list_users(self, after=None, before=None, limit=10, offset=0):
+        return self.history_store.list_users(after, before, limit, offset)
+
+    def count_users(self):
+        return self.history_store.count_users()
+
+    def search(self, text, after=None, before=None, limit=10):
+        return self.history_store.search(text, after, before, limit)
+
+    def iter_turns(self, user_numbers=None):
+        return self.history_store.iter_turns(user_numbers)
+
+    def export(self, user_numbers=None, fmt="jsonl", max_bytes=None):
+        # Returns the number of turns exported and the file's bytes, or None instead of bytes above max_bytes
+        fd, path = tempfile.mkstemp(prefix="tanigpt-export-", suffix=f".{fmt}")
+        os.close(fd)
+        try:
+            count = write_export(self.history_store, path, user_numbers, fmt)
+            if max_bytes is not None and os.path.getsize(path) > max_bytes:
+                return count, None
+            with open(path, 'rb') as f:
+                return count, f.read()
+        finally:
+            os.remove(path)
+
+
+class AsyncUserRepository:
+    """UserRepository for coroutines: each call runs in a worker thread and is timed.
+
+    Turns aren't iterated from here; export() builds a whole export in one thread.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    async def _call(self, operation, func, *args):
+        with STORAGE_SECONDS.time(operation=operation):
+            return await asyncio.to_thread(func, *args)
+
+    async def lookup(self, telegram_id):
+        # Runs on every message; a loaded JSON index answers faster than a thread could be scheduled
+        if self.repository.index_in_memory():
+            return self.repository.lookup_in_memory(telegram_id)
+        return await self._call('lookup', self.repository.lookup, telegram_id)
+
+    async def find_by_phone(self, phone_number):
+        return await self._call('find_by_phone', self.repository.find_by_phone, phone_number)
+
+    async def allocate_number(self):
+        return await self._call('allocate_number', self.repository.allocate_number)
+
+    async def register(self, telegram_id, user_number, phone_number):
+        await self._call('register', self.repository.register, telegram_id, user_number, phone_number)
+
+    async def delete_user(self, user_number):
+        return await self._call('delete_user', self.repository.delete_user, user_number)
+
+    async def delete_by_telegram_id(self, telegram_id):
+        return await self._call('delete_by_telegram_id', self.repository.delete_by_telegram_id, telegram_id)
+
+    async def exists(self, user_number):
+        return await self._call('exists', self.repository.exists, user_number)
+
+    async def profile(self, user_number):
+        return await self._call('load_profile', self.repository.profile, user_number)
+
+    async def history_page(self, user_number, after=None, before=None, limit=10):
+        return await self._call('history_page', self.repository.history_page, user_number, after, before, limit)
+
+    async def list_users(self, after=None, before=None, limit=10, offset=0):
+        return await self._call('list_users', self.repository.list_users, after, before, limit, offset)
+
+    async def count_users(self):
+        return await self._call('count_users', self.repository.count_users)
+
+    async def search(self, text, after=None, before=None, limit=10):
+        return await self._call('search', self.repository.search, text, after, before, limit)
+
+    async def export(self, user_numbers=None, fmt="jsonl", max_bytes=None):
+        return await self._call('export', self.repository.export, user_numbers, fmt, max_bytes)
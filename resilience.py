@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+import httpx
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: rate limits, timeouts and server-side errors
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+LLM_RETRIES = metrics.counter("tanigpt_llm_retries_total", "LLM requests retried after a transient error", ("model", "reason"))
+LLM_FALLBACKS = metrics.counter("tanigpt_llm_fallbacks_total", "LLM requests sent to the fallback model", ("reason",))
+LLM_HEDGES = metrics.counter("tanigpt_llm_hedges_total", "Duplicate LLM requests sent after the latency threshold", ("model", "winner"))
+
+
+def is_transient(error):
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    # mistralai's SDKError carries the HTTP status; checked by attribute to avoid importing the SDK
+    return getattr(error, 'status_code', None) in TRANSIENT_STATUSES
+
+
+class CircuitBreaker:
+    """Stops sending requests to a model after `threshold` failures in a row.
+
+    After `reset_after` seconds one trial request is let through (half-open);
+    success closes the breaker again, failure keeps it open for another period.
+    A trial that ends with neither, because it was cancelled, must call
+    end_trial() so the next request can be let through.
+    """
+
+    def __init__(self, threshold=5, reset_after=30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.trial_running and time.monotonic() - self.opened_at >= self.reset_after:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def end_trial(self):
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    # Recent successful request times, for the hedging threshold
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ResilientInference:
+    """Retries, circuit breaking, hedging and model fallback on top of an InferencePool.
+
+    Transient errors are retried with exponential backoff and jitter, and a
+    request that has used up its retries gets one last try on `fallback_model`.
+    A timeout skips straight to the fallback, since the primary has just used
+    up the whole timeout. Each model has a circuit breaker, and requests
+    for a model whose breaker is open go to `fallback_model`, as do prompts no
+    longer than `short_prompt_chars`. With `hedge` set, a completion that has
+    not finished after the model's `hedge_percentile` latency is sent a second
+    time and the first answer wins. Streams are retried only until their first
+    token, and never hedged.
+    """
+
+    def __init__(self, pool, fallback_model=None, retries=2, backoff=0.5, breaker_threshold=5,
+                 breaker_reset=30.0, hedge=False, hedge_percentile=0.95, short_prompt_chars=0):
+        self.pool = pool
+        self.fallback_model = fallback_model
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.short_prompt_chars = short_prompt_chars
+        self.breakers = {}
+        self.latencies = {}
+
+    def breaker(self, model):
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return self.breakers[model]
+
+    def _latency(self, model):
+        if model not in self.latencies:
+            self.latencies[model] = LatencyTracker()
+        return self.latencies[model]
+
+    def choose_model(self, messages, model=None):
+        # Returns the model and, when the request is a half-open breaker's trial, that breaker
+        model = model or self.pool.model
+        if not self.fallback_model or model == self.fallback_model:
+            return model, None
+        if self.short_prompt_chars and len(messages[-1]['content']) <= self.short_prompt_chars:
+            LLM_FALLBACKS.inc(reason='short_prompt')
+            return self.fallback_model, None
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            LLM_FALLBACKS.inc(reason='breaker_open')
+            return self.fallback_model, None
+        return model, breaker if breaker.is_open() else None
+
+    def _record(self, model, error=None):
+        # A non-transient error (a bad request, say) is still an answer from a working model
+        if error is not None and is_transient(error):
+            self.breaker(model).record_failure()
+        else:
+            self.breaker(model).record_success()
+
+    def _next_model(self, model, error, attempt):
+        # Returns the model for the next attempt, or None to give up
+        if not is_transient(error):
+            return None
+        if self.fallback_model and model != self.fallback_model:
+            if isinstance(error, asyncio.TimeoutError):
+                reason = 'timeout'
+            elif self.breaker(model).is_open():
+                reason = 'breaker_open'
+            elif attempt >= self.retries:
+                reason = 'retries_exhausted'
+            else:
+                return model
+            LLM_FALLBACKS.inc(reason=reason)
+            return self.fallback_model
+        return model if attempt < self.retries else None
+
+    async def _backoff(self, model, error, attempt):
+        reason = 'timeout' if isinstance(error, asyncio.TimeoutError) else type(error).__name__
+        LLM_RETRIES.inc(model=model, reason=reason)
+        delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        logger.warning(f"LLM request to {model} failed ({reason}), retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def _complete_once(self, messages, model):
+        threshold = self._latency(model).percentile(self.hedge_percentile) if self.hedge else None
+        if threshold is None:
+            return await self.pool.complete(messages, model=model)
+
+        first = asyncio.ensure_future(self.pool.complete(messages, model=model))
+        done, _ = await asyncio.wait({first}, timeout=threshold)
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(self.pool.complete(messages, model=model))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()  # The worker thread still finishes, its answer is dropped
+                    LLM_HEDGES.inc(model=model, winner='hedge' if task is second else 'original')
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def complete(self, messages, model=None):
+        model, trial = self.choose_model(messages, model)
+        attempt = 0
+        try:
+            while True:
+                start_time = time.monotonic()
+                try:
+                    response = await self._complete_once(messages, model)
+                except Exception as e:
+                    self._record(model, e)
+                    trial = None  # The trial is always the first attempt
+                    next_model = self._next_model(model, e, attempt)
+                    if next_model is None:
+                        raise
+                    await self._backoff(model, e, attempt)
+                    model = next_model
+                    attempt += 1
+                    continue
+                self._record(model)
+                trial = None
+                self._latency(model).record(time.monotonic() - start_time)
+                return response
+        finally:
+            if trial is not None:
+                trial.end_trial()  # Cancelled before the trial had an outcome
+
+    async def stream(self, messages, model=None):
+        model, trial = self.choose_model(messages, model)
+        attempt = 0
+        try:
+            while True:
+                started = False
+                try:
+                    async for delta in self.pool.stream(messages, model=model):
+                        if not started:
+                            # The first token shows the model is up, whatever the consumer does next
+                            started = True
+                            self._record(model)
+                            trial = None
+                        yield delta
+                except Exception as e:
+                    self._record(model, e)
+                    trial = None
+                    # Tokens already sent can't be taken back
+                    next_model = None if started else self._next_model(model, e, attempt)
+                    if next_model is None:
+                        raise
+                    await self._backoff(model, e, attempt)
+                    model = next_model
+                    attempt += 1
+                    continue
+                if not started:
+                    self._record(model)
+                return
+        finally:
+            if trial is not None:
+                trial.end_trial()  # Cancelled, or the consumer stopped, before the trial had an outcome
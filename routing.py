@@ -0,0 +1,136 @@
+import json
+import logging
+import re
+import metrics
+from context_window import message_tokens
+from llm import LLM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+ROUTES = metrics.counter("tanigpt_routes_total", "Messages routed to each model tier", ("tier", "rule"))
+ROUTE_SECONDS = metrics.histogram(
+    "tanigpt_route_seconds", "LLM time of routed messages, until the last token when streaming", ("tier",)
+)
+
+# Prices are USD per million tokens; the first rule that matches wins
+DEFAULT_ROUTES = {
+    "default": "large",
+    "tiers": {
+        "small": {"model": "mistral-small-latest", "prompt_price": 0.2, "completion_price": 0.6},
+        "large": {"model": "mistral-large-latest", "prompt_price": 2.0, "completion_price": 6.0},
+    },
+    "rules": [
+        {
+            "name": "small_talk",
+            "tier": "small",
+            "matches": r"^\W*(ok(ay)?|k|thanks|thank you|thx|hi+|hello|hey|hm+|bye|good (morning|night)|gm|gn|lol|"
+                       r"ha(ha)+|nice|cool|acc?ha|th?ee?k hai|shukriya|dhanyavaad)\W*$"
+        },
+        {"name": "short_opener", "tier": "small", "max_chars": 40, "max_history_turns": 0},
+    ],
+}
+
+CONDITIONS = {
+    "min_chars", "max_chars", "min_history_turns", "max_history_turns",
+    "min_context_tokens", "max_context_tokens", "scripts", "matches"
+}
+
+
+def script(text):
+    # Cheap language hint: Hindi in Devanagari vs. English/Hinglish in Latin script
+    return "devanagari" if re.search(r"[ऀ-ॿ]", text) else "latin"
+
+
+class Tier:
+    def __init__(self, name, model, prompt_price=0.0, completion_price=0.0):
+        self.name = name
+        self.model = model
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+
+
+class Rule:
+    def __init__(self, name, tier, conditions):
+        unknown = set(conditions) - CONDITIONS
+        if unknown:
+            raise ValueError(f"Unknown condition(s) in routing rule {name}: {', '.join(sorted(unknown))}")
+        self.name = name
+        self.tier = tier
+        self.conditions = conditions
+        self.pattern = re.compile(conditions["matches"], re.IGNORECASE) if "matches" in conditions else None
+
+    def applies(self, features, message):
+        c = self.conditions
+        return (
+            c.get("min_chars", 0) <= features["chars"] <= c.get("max_chars", features["chars"])
+            and c.get("min_history_turns", 0) <= features["history_turns"] <= c.get("max_history_turns", features["history_turns"])
+            and c.get("min_context_tokens", 0) <= features["context_tokens"]
+            <= c.get("max_context_tokens", features["context_tokens"])
+            and features["script"] in c.get("scripts", [features["script"]])
+            and (self.pattern is None or self.pattern.search(message) is not None)
+        )
+
+
+class ModelRouter:
+    """Picks a model tier for each LLM-bound message from a table of rules.
+
+    Rules look only at cheap local features of the message and the context
+    about to be sent (length, history turns, token estimate, script, regex
+    matches). The first rule whose conditions all hold picks the tier;
+    otherwise the default tier is used. Routing decisions, per-tier latency
+    and estimated spend are exported as metrics for tuning the table.
+    """
+
+    def __init__(self, config=DEFAULT_ROUTES, enabled=True):
+        self.enabled = enabled
+        self.tiers = {name: Tier(name, **tier) for name, tier in config["tiers"].items()}
+        self.default = self.tiers[config["default"]]
+        self.rules = []
+        for index, rule in enumerate(config.get("rules", [])):
+            rule = dict(rule)
+            name = rule.pop("name", f"rule{index}")
+            tier = rule.pop("tier")
+            if tier not in self.tiers:
+                raise ValueError(f"Routing rule {name} uses unknown tier {tier}")
+            self.rules.append(Rule(name, self.tiers[tier], rule))
+        logger.info(f"Model routing {'enabled' if enabled else 'disabled'}: {len(self.rules)} rule(s), "
+                    f"tiers {', '.join(f'{t.name}={t.model}' for t in self.tiers.values())}")
+
+    @classmethod
+    def from_file(cls, path, enabled=True):
+        with open(path, 'r') as f:
+            return cls(json.load(f), enabled)
+
+    def features(self, message, messages):
+        return {
+            "chars": len(message),
+            "history_turns": sum(1 for m in messages[:-1] if m['role'] != 'system'),
+            "context_tokens": sum(message_tokens(m) for m in messages),
+            "script": script(message),
+        }
+
+    def route(self, message, messages):
+        # Returns (tier, name of the rule that picked it)
+        tier, rule_name = self.default, "default"
+        if self.enabled:
+            features = self.features(message, messages)
+            for rule in self.rules:
+                if rule.applies(features, message):
+                    tier, rule_name = rule.tier, rule.name
+                    break
+        ROUTES.inc(tier=tier.name, rule=rule_name)
+        return tier, rule_name
+
+    def observe(self, tier, seconds):
+        ROUTE_SECONDS.observe(seconds, tier=tier.name)
+
+    def costs(self):
+        # Estimated USD spent per tier, from the token counts Mistral reports for each model
+        prices = {tier.model: tier for tier in self.tiers.values()}
+        totals = {(tier.name,): 0.0 for tier in self.tiers.values()}
+        for (model, kind), tokens in LLM_TOKENS.samples():
+            tier = prices.get(model)
+            if tier is not None:
+                price = tier.prompt_price if kind == 'prompt' else tier.completion_price
+                totals[(tier.name,)] += tokens * price / 1_000_000
+        return totals
@@ -0,0 +1,178 @@
+import importlib
+import json
+import logging
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# A binary frame starts with 0xff, which never starts UTF-8 text, so frames and JSON lines can't be confused
+FRAME_MARKER = b"\xffTG"
+FRAME_HEADER = struct.Struct(">3sBBI")  # Marker, codec id, compression id, payload length
+
+# orjson writes plain JSON, so either library reads what the other wrote
+CODEC_IDS = {'json': 1, 'orjson': 1, 'msgpack': 2}
+COMPRESSION_IDS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+
+def _require(module, setting):
+    # Optional dependencies are only imported when a format needs them
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ValueError(f"History format {setting} needs the {module} package") from None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _codec(name):
+    # Returns (dumps, loads) working on bytes
+    if name == 'json':
+        return _json_dumps, json.loads
+    if name == 'orjson':
+        orjson = _require('orjson', name)
+        return orjson.dumps, orjson.loads
+    msgpack = _require('msgpack', name)
+    return lambda obj: msgpack.packb(obj, use_bin_type=True), lambda data: msgpack.unpackb(data, raw=False)
+
+
+def _compressor(name, level=None):
+    # Returns (compress, decompress)
+    if name == 'none':
+        return bytes, bytes
+    if name == 'zlib':
+        return lambda data: zlib.compress(data, 6 if level is None else level), zlib.decompress
+    zstd = _require('zstandard', name)
+    # zstandard's (de)compressor objects can't be shared between threads
+    return (
+        lambda data: zstd.ZstdCompressor(level=3 if level is None else level).compress(data),
+        lambda data: zstd.ZstdDecompressor().decompress(data)
+    )
+
+
+class Serializer:
+    """Encodes and decodes history log records in the configured format.
+
+    A format is a codec (json, orjson or msgpack) with optional zlib or zstd
+    compression, written like "msgpack+zstd" or "json+zlib:9". JSON codecs
+    without compression keep logs as JSON lines. Anything else writes binary
+    frames that each hold a list of records. An append then costs one frame,
+    and a compacted history is a single frame that compresses well.
+
+    Frames record their own codec and compression, so a log can be read
+    whatever format it was written in, JSON lines included, as long as the
+    libraries it needs are installed.
+    """
+
+    def __init__(self, codec='json', compression='none', level=None):
+        if codec not in CODEC_IDS:
+            raise ValueError(f"Unknown history codec: {codec}")
+        if compression not in COMPRESSION_IDS:
+            raise ValueError(f"Unknown history compression: {compression}")
+        self.codec = codec
+        self.compression = compression
+        self.dumps, self.loads = _codec(codec)
+        self.compress, _ = _compressor(compression, level)
+        self.text = CODEC_IDS[codec] == CODEC_IDS['json'] and compression == 'none'
+        self.decoders = {}
+
+    @classmethod
+    def from_spec(cls, spec):
+        codec, _, compression = (spec or 'json').lower().partition('+')
+        compression, _, level = (compression or 'none').partition(':')
+        return cls(codec, compression, int(level) if level else None)
+
+    @property
+    def name(self):
+        return self.codec if self.compression == 'none' else f"{self.codec}+{self.compression}"
+
+    def encode(self, records):
+        if self.text:
+            return b"".join(self.dumps(record) + b"\n" for record in records)
+        payload = self.compress(self.dumps(list(records)))
+        header = FRAME_HEADER.pack(FRAME_MARKER, CODEC_IDS[self.codec], COMPRESSION_IDS[self.compression], len(payload))
+        return header + payload
+
+    def _decoder(self, codec_id, compression_id):
+        key = (codec_id, compression_id)
+        if key not in self.decoders:
+            codec = self.codec if CODEC_IDS[self.codec] == codec_id else next(
+                (name for name, value in CODEC_IDS.items() if value == codec_id), None
+            )
+            compression = next((name for name, value in COMPRESSION_IDS.items() if value == compression_id), None)
+            if codec is None or compression is None:
+                raise ValueError(f"Unknown frame format {codec_id}/{compression_id}")
+            self.decoders[key] = (_codec(codec)[1], _compressor(compression)[1])
+        return self.decoders[key]
+
+    def chunks(self, data):
+        """Splits a log into (kind, start, end): 'line', 'frame', or 'torn' for an incomplete frame at the end."""
+        position = 0
+        while position < len(data):
+            if data.startswith(FRAME_MARKER, position):
+                end = position + FRAME_HEADER.size
+                if end <= len(data):
+                    end += FRAME_HEADER.unpack_from(data, position)[3]
+                if end > len(data):
+                    yield 'torn', position, len(data)
+                    return
+                yield 'frame', position, end
+            else:
+                end = data.find(b"\n", position)
+                end = len(data) if end == -1 else end + 1
+                yield 'line', position, end
+            position = end
+
+    def decode(self, data, label="log"):
+        # Yields every record; corrupt lines and frames are logged and skipped
+        lines = []
+        for kind, start, end in self.chunks(data):
+            if kind == 'line':
+                line = data[start:end].strip()
+                if line:
+                    lines.append(line)
+                continue
+            yield from self._decode_lines(lines, label)
+            lines = []
+            if kind == 'torn':
+                logger.error(f"Skipping incomplete frame at the end of {label}")
+                continue
+            _, codec_id, compression_id, _ = FRAME_HEADER.unpack_from(data, start)
+            # A missing library raises here rather than dropping the frame as corrupt
+            loads, decompress = self._decoder(codec_id, compression_id)
+            try:
+                records = loads(decompress(data[start + FRAME_HEADER.size:end]))
+            except Exception as e:
+                # zlib, msgpack and zstd errors don't share a base class
+                logger.error(f"Skipping corrupt frame in {label}: {type(e).__name__}: {str(e)}")
+                continue
+            yield from records
+        yield from self._decode_lines(lines, label)
+
+    def _decode_lines(self, lines, label):
+        if not lines:
+            return []
+        loads = self.loads if CODEC_IDS[self.codec] == CODEC_IDS['json'] else json.loads
+        try:
+            # One parse for the whole run of lines is several times faster than one per line
+            return loads(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            pass
+        records = []
+        for line in lines:
+            try:
+                records.append(loads(line))
+            except ValueError:
+                logger.error(f"Skipping corrupt record in {label}")
+        return records
+
+    def valid_length(self, data):
+        # Where the last complete record ends, to cut a torn write off a framed log
+        length = 0
+        for kind, _, end in self.chunks(data):
+            if kind == 'torn' or (kind == 'line' and not data[:end].endswith(b"\n")):
+                break
+            length = end
+        return length
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STORAGE_SECONDS = metrics.histogram(
+    "tanigpt_storage_seconds", "Time spent in history backend calls", ("operation",)
+)
+
+
+class SessionStore:
+    """Keeps active users' recent history in memory and writes new turns back in batches.
+
+    Handlers take lock(user_number) around read-modify-write cycles and record
+    changes with append() or reset(). A background task hands the queued
+    operations to the history backend every flush_interval seconds; clean
+    sessions beyond max_sessions are evicted least-recently-used first.
+    Operations that fail with an I/O or database error are retried on the next
+    flush, up to max_retries times in a row; any other error, such as the user
+    having been deleted, won't go away by retrying, so they are dropped and logged.
+
+    With shared=True other processes write to the same backend, so sessions
+    without unflushed changes are reloaded on every get().
+
+    Reads that don't go through a session (admin pages, search, export) use
+    the UserRepository; call flush() first when they must see the newest turns.
+    """
+
+    def __init__(self, backend, max_sessions=1000, flush_interval=2.0, max_turns=50, shared=False, max_retries=5):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.flush_interval = flush_interval
+        self.max_turns = max_turns  # Turns of history kept in memory per session
+        self.shared = shared
+        self.max_retries = max_retries
+        self.sessions = OrderedDict()
+        self.pending = {}
+        self.retries = {}  # Flushes in a row that failed, per user
+        self.locks = {}
+        self._flusher = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _call(self, operation, func, *args):
+        # Runs a blocking backend call off the event loop and times it
+        with STORAGE_SECONDS.time(operation=operation):
+            return await asyncio.to_thread(func, *args)
+
+    def lock(self, user_number):
+        if user_number not in self.locks:
+            self.locks[user_number] = asyncio.Lock()
+        return self.locks[user_number]
+
+    def _is_fresh(self, user_number):
+        return user_number in self.sessions and (not self.shared or user_number in self.pending)
+
+    async def get(self, user_number):
+        if self._is_fresh(user_number):
+            self.sessions.move_to_end(user_number)
+            return self.sessions[user_number]
+        user_data = await self._call('load_user', self.backend.load_user, user_number, self.max_turns)
+        cached = self.sessions.get(user_number)
+        if cached is not None:
+            # Refresh in place so extras like the conversation summary survive
+            cached.update(user_data)
+            user_data = cached
+        else:
+            # Another coroutine may have loaded it while we were reading
+            user_data = self.sessions.setdefault(user_number, user_data)
+        self.sessions.move_to_end(user_number)
+        self._evict()
+        return user_data
+
+    async def exists(self, user_number):
+        return user_number in self.sessions or await self._call('exists', self.backend.exists, user_number)
+
+    async def profile(self, user_number):
+        if user_number in self.sessions:
+            user_data = self.sessions[user_number]
+            return {'name': user_data['name'], 'phone_number': user_data['phone_number']}
+        return await self._call('load_profile', self.backend.load_profile, user_number)
+
+    async def create(self, user_number, user_data, telegram_id=None):
+        # Signups are written through immediately
+        self.discard(user_number)
+        await self._call('create_user', self.backend.create_user, user_number, user_data, telegram_id)
+        self.sessions[user_number] = user_data
+        self._evict()
+
+    async def delete(self, user_number):
+        self.discard(user_number)
+        await self._call('delete_user', self.backend.delete_user, user_number)
+
+    def append(self, user_number, *turns):
+        user_data = self.sessions[user_number]
+        user_data['chat_history'] = (user_data['chat_history'] + list(turns))[-self.max_turns:]
+        self._queue(user_number, ('append', list(turns)))
+
+    def reset(self, user_number, chat_history):
+        self.sessions[user_number]['chat_history'] = list(chat_history)
+        self._queue(user_number, ('reset', list(chat_history)))
+
+    def save_summary(self, user_number, summary):
+        # Stored with the history, so it outlives the session; the session itself already has it
+        self._queue(user_number, ('summary', summary))
+
+    def _queue(self, user_number, operation):
+        if user_number in self.sessions:
+            self.sessions.move_to_end(user_number)
+        self.pending.setdefault(user_number, []).append(operation)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    def discard(self, user_number):
+        self.sessions.pop(user_number, None)
+        self.pending.pop(user_number, None)
+        self.retries.pop(user_number, None)
+        self.locks.pop(user_number, None)
+
+    def _evict(self):
+        # Only clean, idle sessions can be dropped; dirty ones wait for the flusher
+        excess = len(self.sessions) - self.max_sessions
+        for user_number in list(self.sessions):
+            if excess <= 0:
+                break
+            lock = self.locks.get(user_number)
+            if user_number in self.pending or (lock is not None and lock.locked()):
+                continue
+            del self.sessions[user_number]
+            self.locks.pop(user_number, None)
+            excess -= 1
+
+    def _write_batch(self, batch):
+        failed = {}
+        for user_number, operations in batch.items():
+            for index, (kind, data) in enumerate(operations):
+                try:
+                    if kind == 'append':
+                        self.backend.append_turns(user_number, data)
+                    elif kind == 'summary':
+                        self.backend.save_summary(user_number, data)
+                    else:
+                        self.backend.reset_history(user_number, data)
+                except Exception as e:
+                    logger.error(f"Error writing history for user {user_number}: {str(e)}")
+                    failed[user_number] = (operations[index:], e)
+                    break
+        try:
+            self.backend.compact_pending()
+        except Exception as e:
+            logger.error(f"Error compacting history: {str(e)}")
+        return failed
+
+    async def flush(self):
+        # One batch at a time so a user's operations reach the backend in order
+        async with self._flush_lock:
+            batch, self.pending = self.pending, {}
+            if not batch:
+                return
+            failed = await self._call('flush', self._write_batch, batch)
+            for user_number in batch:
+                if user_number not in failed:
+                    self.retries.pop(user_number, None)
+            for user_number, (operations, error) in failed.items():
+                retries = self.retries.get(user_number, 0) + 1
+                if not isinstance(error, (OSError, sqlite3.OperationalError)) or retries > self.max_retries:
+                    self.retries.pop(user_number, None)
+                    logger.error(
+                        f"Dropped {len(operations)} unsaved history operation(s) for user {user_number} "
+                        f"after {retries} attempt(s): {str(error)}"
+                    )
+                    continue
+                # Retry on the next flush, ahead of anything queued meanwhile
+                self.retries[user_number] = retries
+                self.pending[user_number] = operations + self.pending.get(user_number, [])
+            logger.info(f"Flushed history for {len(batch) - len(failed)} user(s)")
+
+    def flush_sync(self):
+        # For shutdown paths that no longer have a running event loop
+        batch, self.pending = self.pending, {}
+        if batch:
+            self._write_batch(batch)
+
+    async def _run_flusher(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing user sessions: {str(e)}")
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
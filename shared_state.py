@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+from registry import AlreadyRegistered, PhoneTaken
+
+logger = logging.getLogger(__name__)
+
+
+def connect(db_path):
+    # Several worker processes share the file; WAL lets readers and the single writer overlap
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteUserRegistry:
+    """UserRegistry stored in SQLite so every worker sees the same users.
+
+    Nothing is cached in memory. User numbers come from a counter that is
+    incremented inside a write transaction, so two workers can never hand out
+    the same number, and a UNIQUE constraint keeps phone numbers unique.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_index (
+                telegram_id TEXT PRIMARY KEY,
+                user_number TEXT NOT NULL UNIQUE,
+                phone_number TEXT UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def in_memory(self):
+        return False  # Every read is a query
+
+    def __contains__(self, uid):
+        return bool(self._query("SELECT 1 FROM user_index WHERE telegram_id = ?", (uid,)))
+
+    def __getitem__(self, uid):
+        rows = self._query("SELECT user_number, phone_number FROM user_index WHERE telegram_id = ?", (uid,))
+        if not rows:
+            raise KeyError(uid)
+        return {'user_number': rows[0][0], 'phone_number': rows[0][1]}
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM user_index")[0][0]
+
+    def items(self):
+        rows = self._query(
+            "SELECT telegram_id, user_number, phone_number FROM user_index ORDER BY CAST(user_number AS INTEGER)"
+        )
+        return [(uid, {'user_number': number, 'phone_number': phone}) for uid, number, phone in rows]
+
+    def find_by_phone(self, phone_number):
+        rows = self._query("SELECT telegram_id FROM user_index WHERE phone_number = ?", (phone_number,))
+        return rows[0][0] if rows else None
+
+    def find_by_number(self, user_number):
+        rows = self._query("SELECT telegram_id FROM user_index WHERE user_number = ?", (user_number,))
+        return rows[0][0] if rows else None
+
+    def allocate_number(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO counters (name, value) "
+                    "SELECT 'user_number', COALESCE(MAX(CAST(user_number AS INTEGER)), 0) FROM user_index"
+                )
+                value = self.conn.execute(
+                    "UPDATE counters SET value = value + 1 WHERE name = 'user_number' RETURNING value"
+                ).fetchone()[0]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return str(value)
+
+    def add(self, uid, user_number, phone_number):
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT INTO user_index (telegram_id, user_number, phone_number) VALUES (?, ?, ?)",
+                    (uid, user_number, phone_number)
+                )
+        except sqlite3.IntegrityError:
+            rows = self._query("SELECT user_number FROM user_index WHERE telegram_id = ?", (uid,))
+            if rows:
+                raise AlreadyRegistered(uid, rows[0][0])
+            if self.find_by_phone(phone_number):
+                raise PhoneTaken(phone_number)
+            raise
+
+    def remove(self, uid):
+        with self.lock:
+            self.conn.execute("DELETE FROM user_index WHERE telegram_id = ?", (uid,))
+
+    def import_users(self, entries):
+        # Seeds the table from the JSON registry; existing rows win
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO user_index (telegram_id, user_number, phone_number) VALUES (?, ?, ?)",
+                [(uid, data['user_number'], data.get('phone_number')) for uid, data in entries]
+            )
+
+    def missing_phones(self):
+        return [row[0] for row in self._query("SELECT telegram_id FROM user_index WHERE phone_number IS NULL")]
+
+    def rebuild_phones(self, history_store):
+        for uid, data in self.items():
+            try:
+                phone_number = history_store.load_profile(data['user_number'])['phone_number']
+                with self.lock:
+                    self.conn.execute("UPDATE user_index SET phone_number = ? WHERE telegram_id = ?", (phone_number, uid))
+            except Exception as e:
+                logger.error(f"Error rebuilding phone number of user {data['user_number']}: {str(e)}")
+        logger.info(f"Rebuilt phone index for {len(self)} user(s)")
+
+
+class SqlitePersistence(BasePersistence):
+    """python-telegram-bot persistence shared by all workers through SQLite.
+
+    user_data and chat_data are re-read before every update (refresh_*), and
+    SharedConversationHandler writes conversation states and user_data through
+    as soon as a callback returns, so a signup started on one worker can finish
+    on another. PTB's periodic job would only replay this worker's possibly
+    older copies over newer ones, so those updates are ignored. The async
+    methods run their queries in a worker thread, since a busy database can
+    block for up to the connection timeout.
+    """
+
+    def __init__(self, db_path):
+        super().__init__(store_data=PersistenceInput(callback_data=False))
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ptb_data (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (kind, key)
+            );
+            CREATE TABLE IF NOT EXISTS ptb_conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+        """)
+
+    def _load(self, kind, key):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM ptb_data WHERE kind = ? AND key = ?", (kind, str(key))).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _load_all(self, kind):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, data FROM ptb_data WHERE kind = ?", (kind,)).fetchall()
+        return {int(key): pickle.loads(data) for key, data in rows}
+
+    def _store(self, kind, key, data):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ptb_data (kind, key, data) VALUES (?, ?, ?)",
+                (kind, str(key), pickle.dumps(data))
+            )
+
+    def _drop(self, kind, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM ptb_data WHERE kind = ? AND key = ?", (kind, str(key)))
+
+    def load_conversation(self, name, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM ptb_conversations WHERE name = ? AND key = ?", (name, json.dumps(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store_conversation(self, name, key, state):
+        with self.lock:
+            if state is None:
+                self.conn.execute("DELETE FROM ptb_conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO ptb_conversations (name, key, state) VALUES (?, ?, ?)",
+                    (name, json.dumps(key), json.dumps(state))
+                )
+
+    def store_user_data(self, user_id, data):
+        self._store('user', user_id, dict(data))
+
+    async def get_user_data(self):
+        return await asyncio.to_thread(self._load_all, 'user')
+
+    async def get_chat_data(self):
+        return await asyncio.to_thread(self._load_all, 'chat')
+
+    async def get_bot_data(self):
+        return await asyncio.to_thread(self._load, 'bot', '') or {}
+
+    async def get_callback_data(self):
+        return None
+
+    def _load_conversations(self, name):
+        with self.lock:
+            rows = self.conn.execute("SELECT key, state FROM ptb_conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_conversations(self, name):
+        return await asyncio.to_thread(self._load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        await asyncio.to_thread(self._store, 'chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        await asyncio.to_thread(self._store, 'bot', '', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await asyncio.to_thread(self._drop, 'user', user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await asyncio.to_thread(self._drop, 'chat', chat_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        stored = await asyncio.to_thread(self._load, 'user', user_id)
+        if stored is not None:
+            user_data.clear()
+            user_data.update(stored)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        stored = await asyncio.to_thread(self._load, 'chat', chat_id)
+        if stored is not None:
+            chat_data.clear()
+            chat_data.update(stored)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler whose states live in SqlitePersistence instead of one process.
+
+    PTB only reads persisted conversations once at startup, so refresh() re-reads
+    the current state of a conversation before every update (see
+    conversation_refresher), and the state is written back, together with the
+    user's user_data, as soon as its callback returns.
+
+    ConversationHandler has no public way to set a conversation's state, so this
+    uses its private _get_key() and _conversations. requirements.txt pins
+    python-telegram-bot for that reason, and __init__ fails fast if they're gone.
+    """
+
+    def __init__(self, *args, shared_persistence, **kwargs):
+        super().__init__(*args, persistent=True, **kwargs)
+        if not callable(getattr(self, '_get_key', None)) or not isinstance(getattr(self, '_conversations', None), dict):
+            raise RuntimeError("This python-telegram-bot version's ConversationHandler can't be shared, see requirements.txt")
+        self.shared_persistence = shared_persistence
+
+    async def refresh(self, update):
+        if isinstance(update, Update) and update.effective_chat and update.effective_user:
+            key = self._get_key(update)
+            state = await asyncio.to_thread(self.shared_persistence.load_conversation, self.name, key)
+            if state is None:
+                self._conversations.pop(key, None)
+            else:
+                self._conversations[key] = state
+
+    async def handle_update(self, update, application, check_result, context):
+        result = await super().handle_update(update, application, check_result, context)
+        key = check_result[1]
+        state = self._conversations.get(key)
+        # Pending (non-blocking) states can't be shared between processes
+        if state is None or isinstance(state, int):
+            await asyncio.to_thread(self.shared_persistence.store_conversation, self.name, key, state)
+        if update.effective_user:
+            await asyncio.to_thread(
+                self.shared_persistence.store_user_data, update.effective_user.id, dict(context.user_data)
+            )
+        return result
+
+
+def conversation_refresher(handlers):
+    """A handler that refreshes the states of `handlers` before they see an update.
+
+    ConversationHandler.check_update() is synchronous, so the states can't be
+    loaded there without blocking the event loop. Add this handler in a group
+    before the conversations' own; PTB awaits it before checking later groups.
+    """
+    async def refresh(update, context):
+        for handler in handlers:
+            await handler.refresh(update)
+    return TypeHandler(Update, refresh)
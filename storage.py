@@ -0,0 +1,919 @@
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from durable import GroupCommitter, atomic_write, quarantine, remove_stale_temps, repair_torn_tail, write_json
+from serialization import Serializer
+
+logger = logging.getLogger(__name__)
+
+
+def message_count(turns):
+    return sum(1 for turn in turns if turn['role'] != 'system')
+
+
+class UserSummaryIndex:
+    """One small row per user (name, phone, message count, last activity) for paging through users.
+
+    Rows are keyed by the integer user number, so pages are index range scans
+    whatever the number of users. Callers own the connection and its locking,
+    which lets the SQLite backend update the index in the same transaction as
+    the turns themselves.
+    """
+
+    COLUMNS = "user_number, telegram_id, name, phone_number, message_count, last_active"
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_summaries (
+                user_number INTEGER PRIMARY KEY,
+                telegram_id TEXT,
+                name TEXT NOT NULL,
+                phone_number TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                last_active REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def is_built(self):
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'summaries_built'").fetchone() is not None
+
+    def mark_built(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('summaries_built', '1')")
+
+    def upsert(self, user_number, telegram_id, name, phone_number, messages, last_active):
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO user_summaries ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+            (int(user_number), telegram_id, name, phone_number, messages, last_active)
+        )
+
+    def record_turns(self, user_number, messages, ts):
+        self.conn.execute(
+            "UPDATE user_summaries SET message_count = message_count + ?, last_active = ? WHERE user_number = ?",
+            (messages, ts, int(user_number))
+        )
+
+    def reset_turns(self, user_number, messages, ts):
+        # After a history reset the count starts over from the turns that were kept
+        self.conn.execute(
+            "UPDATE user_summaries SET message_count = ?, last_active = ? WHERE user_number = ?",
+            (messages, ts, int(user_number))
+        )
+
+    def remove(self, user_number):
+        self.conn.execute("DELETE FROM user_summaries WHERE user_number = ?", (int(user_number),))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM user_summaries").fetchone()[0]
+
+    def get(self, user_number):
+        rows, _ = self.page(after=int(user_number) - 1, limit=1)
+        return rows[0] if rows and rows[0]['user_number'] == str(int(user_number)) else None
+
+    def page(self, after=None, before=None, limit=10, offset=0):
+        # Returns (rows, whether there are more in the direction of travel); offset is for numbered pages
+        if before is not None:
+            rows = self.conn.execute(
+                f"SELECT {self.COLUMNS} FROM user_summaries WHERE user_number < ? ORDER BY user_number DESC LIMIT ?",
+                (int(before), limit + 1)
+            ).fetchall()
+            more = len(rows) > limit
+            rows = list(reversed(rows[:limit]))
+        else:
+            rows = self.conn.execute(
+                f"SELECT {self.COLUMNS} FROM user_summaries WHERE user_number > ? ORDER BY user_number LIMIT ? OFFSET ?",
+                (int(after or 0), limit + 1, offset)
+            ).fetchall()
+            more = len(rows) > limit
+            rows = rows[:limit]
+        return [{
+            'user_number': str(row[0]),
+            'telegram_id': row[1],
+            'name': row[2],
+            'phone_number': row[3],
+            'message_count': row[4],
+            'last_active': row[5]
+        } for row in rows], more
+
+
+def fts_query(text):
+    # Every word has to match; quoting keeps FTS5 from parsing operators and punctuation
+    return " ".join(f'"{term}"' for term in re.findall(r"\w+", text))
+
+
+class SearchIndex:
+    """FTS5 full-text index over a table of turns (id, user_number, role, content, ts).
+
+    Triggers keep the index in step with every insert into and delete from that
+    table, so it is updated incrementally as turns are saved. Without FTS5 in
+    the SQLite build, search is disabled and everything else keeps working.
+    """
+
+    def __init__(self, conn, content_table):
+        self.conn = conn
+        self.content_table = content_table
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        try:
+            self.conn.executescript(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(
+                    content, content='{content_table}', content_rowid='id'
+                );
+                CREATE TRIGGER IF NOT EXISTS turns_fts_insert AFTER INSERT ON {content_table} BEGIN
+                    INSERT INTO turns_fts (rowid, content) VALUES (new.id, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS turns_fts_delete AFTER DELETE ON {content_table} BEGIN
+                    INSERT INTO turns_fts (turns_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END;
+            """)
+            self.enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text search disabled, SQLite has no FTS5: {str(e)}")
+            self.enabled = False
+
+    def is_built(self):
+        return not self.enabled or self.conn.execute("SELECT 1 FROM meta WHERE key = 'search_built'").fetchone() is not None
+
+    def rebuild(self):
+        if self.enabled:
+            self.conn.execute("INSERT INTO turns_fts (turns_fts) VALUES ('rebuild')")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('search_built', '1')")
+
+    def search(self, text, after=None, before=None, limit=10):
+        # Newest matches first; same cursor contract as history pages
+        match = fts_query(text)
+        if not self.enabled or not match:
+            return [], False
+        select = (
+            f"SELECT c.id, c.user_number, c.role, snippet(turns_fts, 0, '«', '»', '…', 16), c.ts "
+            f"FROM turns_fts JOIN {self.content_table} c ON c.id = turns_fts.rowid "
+            f"WHERE turns_fts MATCH ? AND c.role != 'system' "
+        )
+        if after is None:
+            rows = self.conn.execute(
+                select + "AND turns_fts.rowid < ? ORDER BY turns_fts.rowid DESC LIMIT ?",
+                (match, int(before) if before is not None else sys.maxsize, limit + 1)
+            ).fetchall()
+            more = len(rows) > limit
+            rows = list(reversed(rows[:limit]))
+        else:
+            rows = self.conn.execute(
+                select + "AND turns_fts.rowid > ? ORDER BY turns_fts.rowid LIMIT ?",
+                (match, int(after), limit + 1)
+            ).fetchall()
+            more = len(rows) > limit
+            rows = rows[:limit]
+        return [(row[0], {
+            'user_number': row[1],
+            'role': row[2],
+            'snippet': row[3],
+            'ts': row[4]
+        }) for row in rows], more
+
+
+# Appended binary frames after which a log is repacked into a single frame
+REPACK_FRAMES = 32
+
+
+def page_entries(entries, after=None, before=None, limit=10):
+    # Like UserSummaryIndex.page over a list of (cursor, item), except that no cursor means the newest page
+    if after is None:
+        older = [entry for entry in entries if before is None or entry[0] < before]
+        return older[-limit:], len(older) > limit
+    newer = [entry for entry in entries if after is None or entry[0] > after]
+    return newer[:limit], len(newer) > limit
+
+
+class JsonlHistoryStore:
+    """Profile and conversation summary in user_N.json, conversation as an append-only log in user_N.jsonl.
+
+    Every log record is one turn ({"role", "content", "ts"}) or a {"op": "clear"}
+    marker, so saving a message costs one short append instead of rewriting the
+    whole history. Compaction rewrites a log down to its live turns. Old
+    user_N.json files that still carry chat_history are read transparently and
+    migrated on first write. The user summary index and the search index
+    live in a small SQLite file next to the logs.
+
+    `serializer` picks the log format. Binary formats log to user_N.log
+    instead. A log in the other layout is still read, and is converted the
+    next time the user's history is written.
+
+    Documents are replaced atomically and appends are made durable through
+    `committer`, which by default fsyncs every write as it happens.
+    """
+
+    def __init__(self, data_dir, retention=0, committer=None, serializer=None):
+        self.data_dir = data_dir
+        self.serializer = serializer if serializer is not None else Serializer()
+        self.retention = retention  # Max turns kept by compaction, 0 keeps everything
+        self.committer = committer if committer is not None else GroupCommitter(0)
+        self.needs_compaction = set()
+        self.appended_frames = {}  # Binary frames appended per user since the log was last packed
+        self.appended_turns = {}  # Turns appended per user since the log was last compacted
+        os.makedirs(data_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(data_dir, "index.db"), check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS search_docs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_number TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                ts REAL
+            );
+            CREATE INDEX IF NOT EXISTS search_docs_by_user ON search_docs (user_number);
+        """)
+        self.summaries = UserSummaryIndex(self.conn)
+        self.search_index = SearchIndex(self.conn, "search_docs")
+
+    def _index_turns(self, user_number, turns, ts, replace=False):
+        # Mirrors the live history into search_docs; call with self.lock held
+        if not self.search_index.enabled:
+            return
+        if replace:
+            self.conn.execute("DELETE FROM search_docs WHERE user_number = ?", (user_number,))
+        self.conn.executemany(
+            "INSERT INTO search_docs (user_number, role, content, ts) VALUES (?, ?, ?, ?)",
+            [(user_number, turn['role'], turn['content'], ts) for turn in turns if turn['role'] != 'system']
+        )
+
+    def profile_path(self, user_number):
+        return os.path.join(self.data_dir, f"user_{user_number}.json")
+
+    def log_path(self, user_number, text=None):
+        # Where the configured format logs to, or the given layout's file
+        text = self.serializer.text if text is None else text
+        return os.path.join(self.data_dir, f"user_{user_number}.{'jsonl' if text else 'log'}")
+
+    def _existing_log(self, user_number):
+        # The user's log in either layout, the configured one first; None if there is none
+        for text in (self.serializer.text, not self.serializer.text):
+            path = self.log_path(user_number, text)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _write_json(self, path, data):
+        write_json(path, data, self.committer, indent=None)
+
+    def _write_log(self, user_number, turns):
+        atomic_write(
+            self.log_path(user_number), lambda f: f.write(self.serializer.encode(turns)), self.committer, encoding=None
+        )
+        other = self.log_path(user_number, not self.serializer.text)
+        if os.path.exists(other):
+            os.remove(other)  # Converted into the log just written
+
+    def _append_log(self, user_number, records):
+        with open(self.log_path(user_number), 'ab') as f:
+            f.write(self.serializer.encode(records))
+        self.committer.sync(self.log_path(user_number))
+        if not self.serializer.text:
+            self.appended_frames[user_number] = self.appended_frames.get(user_number, 0) + 1
+            if self.appended_frames[user_number] >= REPACK_FRAMES:
+                self.needs_compaction.add(user_number)
+        if self.retention:
+            # Compacted once it may hold `retention` turns too many, so a log stays under twice the limit
+            self.appended_turns[user_number] = self.appended_turns.get(user_number, 0) + len(records)
+            if self.appended_turns[user_number] >= self.retention:
+                self.needs_compaction.add(user_number)
+
+    def _repair_log(self, path):
+        # Cuts a torn last record off the log; returns the bytes removed
+        if path.endswith(".jsonl"):
+            return repair_torn_tail(path)
+        with open(path, 'rb+') as f:
+            data = f.read()
+            keep = self.serializer.valid_length(data)
+            if keep < len(data):
+                f.truncate(keep)
+                logger.warning(f"Cut {len(data) - keep} byte(s) of a torn write off {path}")
+        return len(data) - keep
+
+    def _read_profile(self, user_number):
+        with open(self.profile_path(user_number), 'r') as f:
+            return json.load(f)
+
+    def _read_log(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _replay(self, user_number, limit=None, with_ts=False):
+        # Returns (live turns, total records in the log)
+        return self._live_turns(user_number, self._read_log(self._existing_log(user_number)), limit, with_ts)
+
+    def _live_turns(self, user_number, data, limit=None, with_ts=False):
+        turns = deque(maxlen=limit)
+        records = 0
+        for record in self.serializer.decode(data, label=f"log for user {user_number}"):
+            records += 1
+            if record.get('op') == 'clear':
+                turns.clear()
+            else:
+                turn = {"role": record['role'], "content": record['content']}
+                if with_ts:
+                    turn['ts'] = record.get('ts')
+                turns.append(turn)
+        return list(turns), records
+
+    def user_numbers(self):
+        numbers = []
+        for path in glob.glob(os.path.join(self.data_dir, "user_*.json")):
+            match = re.match(r"user_(\d+)\.json$", os.path.basename(path))
+            if match:
+                numbers.append(match.group(1))
+        return sorted(numbers, key=int)
+
+    def exists(self, user_number):
+        return os.path.exists(self.profile_path(user_number))
+
+    def load_profile(self, user_number):
+        profile = self._read_profile(user_number)
+        return {'name': profile['name'], 'phone_number': profile['phone_number']}
+
+    def load_user(self, user_number, limit=None):
+        profile = self._read_profile(user_number)
+        if self._existing_log(user_number):
+            chat_history, _ = self._replay(user_number, limit)
+        else:
+            chat_history = profile.get('chat_history', [])
+            if limit:
+                chat_history = chat_history[-limit:]
+        return {
+            'name': profile['name'], 'phone_number': profile['phone_number'], 'chat_history': chat_history,
+            'summary': profile.get('summary')
+        }
+
+    def create_user(self, user_number, user_data, telegram_id=None):
+        chat_history = user_data.get('chat_history', [])
+        self._write_log(user_number, chat_history)
+        profile = {'name': user_data['name'], 'phone_number': user_data['phone_number']}
+        if user_data.get('summary'):
+            profile['summary'] = user_data['summary']
+        self._write_json(self.profile_path(user_number), profile)
+        now = time.time()
+
+        def update():
+            self.summaries.upsert(
+                user_number, telegram_id, user_data['name'], user_data['phone_number'],
+                message_count(chat_history), now
+            )
+            self._index_turns(user_number, chat_history, now, replace=True)
+        self._update_index(user_number, update)
+
+    def _update_index(self, user_number, update):
+        """Runs update() in one index transaction, after the files have been written.
+
+        The files are the source of truth and the index can be rebuilt from
+        them, so a failed update is rolled back and logged instead of raised.
+        Raising would make SessionStore retry the whole operation and append
+        the same turns to the log again.
+        """
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                update()
+                self.conn.execute("COMMIT")
+            except Exception as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                logger.error(
+                    f"Error updating the index for user {user_number}, "
+                    f"run manage.py rebuild-user-summaries and rebuild-search-index: {str(e)}"
+                )
+
+    def migrate_legacy(self, user_number):
+        # Move chat_history out of the profile document into the log
+        profile = self._read_profile(user_number)
+        if 'chat_history' not in profile:
+            return False
+        if not self._existing_log(user_number):
+            self._write_log(user_number, profile['chat_history'])
+        del profile['chat_history']
+        self._write_json(self.profile_path(user_number), profile)
+        return True
+
+    def _ensure_log(self, user_number):
+        # Appends go to a log in the configured format
+        if os.path.exists(self.log_path(user_number)):
+            return
+        if self._existing_log(user_number):
+            turns, _ = self._replay(user_number, with_ts=True)
+            self._write_log(user_number, turns)
+            logger.info(f"Converted log of user {user_number} to {self.serializer.name}")
+        else:
+            self.migrate_legacy(user_number)
+
+    def append_turns(self, user_number, turns):
+        self._ensure_log(user_number)
+        now = time.time()
+        self._append_log(user_number, [{**turn, 'ts': now} for turn in turns])
+
+        def update():
+            self.summaries.record_turns(user_number, message_count(turns), now)
+            self._index_turns(user_number, turns, now)
+        self._update_index(user_number, update)
+
+    def save_summary(self, user_number, summary):
+        # The conversation summary is rewritten rarely, so it lives in the profile document
+        profile = self._read_profile(user_number)
+        if summary:
+            profile['summary'] = summary
+        elif profile.pop('summary', None) is None:
+            return
+        self._write_json(self.profile_path(user_number), profile)
+
+    def reset_history(self, user_number, chat_history):
+        self._ensure_log(user_number)
+        now = time.time()
+        self._append_log(user_number, [{'op': 'clear', 'ts': now}] + [{**turn, 'ts': now} for turn in chat_history])
+        self.save_summary(user_number, None)  # It summarized the turns just cleared
+        self.needs_compaction.add(user_number)
+
+        def update():
+            self.summaries.reset_turns(user_number, message_count(chat_history), now)
+            self._index_turns(user_number, chat_history, now, replace=True)
+        self._update_index(user_number, update)
+
+    def delete_user(self, user_number):
+        for path in (self.log_path(user_number, True), self.log_path(user_number, False), self.profile_path(user_number)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.committer.sync(self.data_dir)
+        self.needs_compaction.discard(user_number)
+        self.appended_frames.pop(user_number, None)
+        self.appended_turns.pop(user_number, None)
+
+        def update():
+            self.summaries.remove(user_number)
+            self._index_turns(user_number, [], None, replace=True)
+        self._update_index(user_number, update)
+
+    def iter_turns(self, user_numbers=None):
+        # One user's history in memory at a time
+        for user_number in user_numbers or self.user_numbers():
+            if not self.exists(user_number):
+                continue
+            if self._existing_log(user_number):
+                turns, _ = self._replay(user_number, with_ts=True)
+            else:
+                turns = self._read_profile(user_number).get('chat_history', [])
+            for turn in turns:
+                yield {'user_number': user_number, 'role': turn['role'], 'content': turn['content'], 'ts': turn.get('ts')}
+
+    def search(self, text, after=None, before=None, limit=10):
+        with self.lock:
+            return self.search_index.search(text, after, before, limit)
+
+    def search_built(self):
+        with self.lock:
+            return self.search_index.is_built()
+
+    def rebuild_search(self):
+        # Re-reads every log into search_docs
+        with self.lock:
+            self.conn.execute("DELETE FROM search_docs")
+        indexed = 0
+        for user_number in self.user_numbers():
+            try:
+                turns = self.load_user(user_number)['chat_history']
+                with self.lock:
+                    self._index_turns(user_number, turns, None)
+                indexed += 1
+            except Exception as e:
+                logger.error(f"Error indexing history of user {user_number}: {str(e)}")
+        with self.lock:
+            self.search_index.rebuild()
+        logger.info(f"Built search index for {indexed} user(s)")
+
+    def history_page(self, user_number, after=None, before=None, limit=10):
+        # Cursors are positions in the live history; the log has to be replayed either way.
+        # Without a cursor the newest page is returned.
+        chat_history = self.load_user(user_number)['chat_history']
+        entries = [(position, turn) for position, turn in enumerate(chat_history) if turn['role'] != 'system']
+        return page_entries(entries, after, before, limit)
+
+    def list_users(self, after=None, before=None, limit=10, offset=0):
+        with self.lock:
+            return self.summaries.page(after, before, limit, offset)
+
+    def count_users(self):
+        with self.lock:
+            return self.summaries.count()
+
+    def summaries_built(self):
+        with self.lock:
+            return self.summaries.is_built()
+
+    def rebuild_summaries(self, telegram_ids=None):
+        # One-off scan for data written before the index existed
+        telegram_ids = telegram_ids or {}
+        for user_number in self.user_numbers():
+            try:
+                user_data = self.load_user(user_number)
+                last_active = os.path.getmtime(self._existing_log(user_number) or self.profile_path(user_number))
+                with self.lock:
+                    self.summaries.upsert(
+                        user_number, telegram_ids.get(user_number), user_data['name'], user_data['phone_number'],
+                        message_count(user_data['chat_history']), last_active
+                    )
+            except Exception as e:
+                logger.error(f"Error indexing user {user_number}: {str(e)}")
+        with self.lock:
+            self.summaries.mark_built()
+        logger.info(f"Built user summary index for {self.count_users()} user(s)")
+
+    def check_integrity(self, repair=True):
+        """Startup scan for damage a crash can leave behind.
+
+        Leftover temp files are removed, torn last lines are cut off the logs,
+        and unreadable profiles are rewritten from the user summary index or,
+        failing that, moved to quarantine/. Returns the number of problems found.
+        """
+        problems = 0
+        if repair:
+            problems += remove_stale_temps(self.data_dir)
+        for user_number in self.user_numbers():
+            log_path = self._existing_log(user_number)
+            if log_path and repair:
+                problems += bool(self._repair_log(log_path))
+            try:
+                profile = self._read_profile(user_number)
+                if not isinstance(profile, dict) or 'name' not in profile or 'phone_number' not in profile:
+                    raise ValueError("missing name or phone number")
+                continue
+            except (OSError, ValueError) as e:
+                problems += 1
+                logger.error(f"Profile of user {user_number} is unreadable: {str(e)}")
+                if not repair:
+                    continue
+            with self.lock:
+                summary = self.summaries.get(user_number)
+            path = quarantine(self.profile_path(user_number), "unreadable profile")
+            if summary is not None:
+                self._write_json(self.profile_path(user_number), {
+                    'name': summary['name'],
+                    'phone_number': summary['phone_number']
+                })
+                logger.warning(f"Restored profile of user {user_number} from the user summary index")
+            elif log_path:
+                logger.error(f"No copy of user {user_number}'s profile; history kept in {log_path}, profile in {path}")
+        if problems:
+            logger.warning(f"Integrity check of {self.data_dir} found {problems} problem(s)")
+        return problems
+
+    def compact(self, user_number):
+        path = self._existing_log(user_number)
+        if path is None:
+            return
+        data = self._read_log(path)
+        turns, records = self._live_turns(user_number, data, with_ts=True)
+        if self.retention and len(turns) > self.retention:
+            turns = turns[-self.retention:]
+        # Binary frames are compressed one by one; repacked into one frame they compress far better
+        repack = path != self.log_path(user_number) or (
+            not self.serializer.text and sum(1 for _ in self.serializer.chunks(data)) > 1
+        )
+        self.appended_frames.pop(user_number, None)
+        self.appended_turns.pop(user_number, None)
+        if len(turns) < records or repack:
+            self._write_log(user_number, turns)
+            logger.info(f"Compacted log for user {user_number}: {records} -> {len(turns)} records")
+
+    def compact_pending(self):
+        while self.needs_compaction:
+            self.compact(self.needs_compaction.pop())
+
+    def compact_all(self):
+        for user_number in self.user_numbers():
+            self.compact(user_number)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteHistoryStore:
+    """Profiles and turns in one SQLite database running in WAL mode."""
+
+    def __init__(self, db_path, retention=0):
+        self.db_path = db_path
+        self.retention = retention  # Max turns kept per user, 0 keeps everything
+        self.appended_turns = {}  # Turns appended per user since retention was last applied
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_number TEXT PRIMARY KEY,
+                telegram_id TEXT,
+                name TEXT NOT NULL,
+                phone_number TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_number TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                ts REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_by_user ON turns (user_number, id);
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if 'conversation_summary' not in columns:
+            # JSON of the rolling summary ContextBuilder folds old turns into; added after the table
+            self.conn.execute("ALTER TABLE users ADD COLUMN conversation_summary TEXT")
+        self.summaries = UserSummaryIndex(self.conn)
+        self.search_index = SearchIndex(self.conn, "turns")
+
+    def _insert_turns(self, user_number, turns):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO turns (user_number, role, content, ts) VALUES (?, ?, ?, ?)",
+            [(user_number, turn['role'], turn['content'], now) for turn in turns]
+        )
+        return now
+
+    def user_numbers(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT user_number FROM users").fetchall()
+        return sorted((row[0] for row in rows), key=int)
+
+    def exists(self, user_number):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM users WHERE user_number = ?", (user_number,)).fetchone()
+        return row is not None
+
+    def load_profile(self, user_number):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT name, phone_number FROM users WHERE user_number = ?", (user_number,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown user number {user_number}")
+        return {'name': row[0], 'phone_number': row[1]}
+
+    def load_user(self, user_number, limit=None):
+        profile = self.load_profile(user_number)
+        with self.lock:
+            summary = self.conn.execute(
+                "SELECT conversation_summary FROM users WHERE user_number = ?", (user_number,)
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT role, content FROM ("
+                "SELECT id, role, content FROM turns WHERE user_number = ? ORDER BY id DESC LIMIT ?"
+                ") ORDER BY id",
+                (user_number, limit or -1)
+            ).fetchall()
+        profile['chat_history'] = [{"role": role, "content": content} for role, content in rows]
+        profile['summary'] = json.loads(summary) if summary else None
+        return profile
+
+    def create_user(self, user_number, user_data, telegram_id=None):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM turns WHERE user_number = ?", (user_number,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO users (user_number, telegram_id, name, phone_number, conversation_summary) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (user_number, telegram_id, user_data['name'], user_data['phone_number'],
+                     json.dumps(user_data['summary']) if user_data.get('summary') else None)
+                )
+                chat_history = user_data.get('chat_history', [])
+                now = self._insert_turns(user_number, chat_history)
+                self.summaries.upsert(
+                    user_number, telegram_id, user_data['name'], user_data['phone_number'],
+                    message_count(chat_history), now
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def append_turns(self, user_number, turns):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = self._insert_turns(user_number, turns)
+                self.summaries.record_turns(user_number, message_count(turns), now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if self.retention:
+            self.appended_turns[user_number] = self.appended_turns.get(user_number, 0) + len(turns)
+
+    def reset_history(self, user_number, chat_history):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM turns WHERE user_number = ?", (user_number,))
+                self.conn.execute("UPDATE users SET conversation_summary = NULL WHERE user_number = ?", (user_number,))
+                now = self._insert_turns(user_number, chat_history)
+                self.summaries.reset_turns(user_number, message_count(chat_history), now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def save_summary(self, user_number, summary):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE users SET conversation_summary = ? WHERE user_number = ?",
+                (json.dumps(summary) if summary else None, user_number)
+            )
+
+    def delete_user(self, user_number):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM turns WHERE user_number = ?", (user_number,))
+                self.conn.execute("DELETE FROM users WHERE user_number = ?", (user_number,))
+                self.summaries.remove(user_number)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        self.appended_turns.pop(user_number, None)
+
+    def history_page(self, user_number, after=None, before=None, limit=10):
+        # Cursors are turn ids; without one the newest page is returned
+        with self.lock:
+            if after is None:
+                rows = self.conn.execute(
+                    "SELECT id, role, content FROM turns WHERE user_number = ? AND role != 'system' AND id < ? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (user_number, int(before) if before is not None else sys.maxsize, limit + 1)
+                ).fetchall()
+                more = len(rows) > limit
+                rows = list(reversed(rows[:limit]))
+            else:
+                rows = self.conn.execute(
+                    "SELECT id, role, content FROM turns WHERE user_number = ? AND role != 'system' AND id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (user_number, int(after), limit + 1)
+                ).fetchall()
+                more = len(rows) > limit
+                rows = rows[:limit]
+        return [(row[0], {"role": row[1], "content": row[2]}) for row in rows], more
+
+    def list_users(self, after=None, before=None, limit=10, offset=0):
+        with self.lock:
+            return self.summaries.page(after, before, limit, offset)
+
+    def count_users(self):
+        with self.lock:
+            return self.summaries.count()
+
+    def iter_turns(self, user_numbers=None, batch_size=1000):
+        # Reads in keyset batches so writers aren't locked out for the whole export
+        position = ('', 0)
+        where = ""
+        params = []
+        if user_numbers:
+            where = f"AND user_number IN ({', '.join('?' * len(user_numbers))}) "
+            params = list(user_numbers)
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT id, user_number, role, content, ts FROM turns WHERE (user_number, id) > (?, ?) {where}"
+                    f"ORDER BY user_number, id LIMIT ?",
+                    [*position, *params, batch_size]
+                ).fetchall()
+            for row in rows:
+                yield {'user_number': row[1], 'role': row[2], 'content': row[3], 'ts': row[4]}
+            if len(rows) < batch_size:
+                return
+            position = (rows[-1][1], rows[-1][0])
+
+    def search(self, text, after=None, before=None, limit=10):
+        with self.lock:
+            return self.search_index.search(text, after, before, limit)
+
+    def search_built(self):
+        with self.lock:
+            return self.search_index.is_built()
+
+    def rebuild_search(self):
+        with self.lock:
+            self.search_index.rebuild()
+        logger.info("Built search index")
+
+    def summaries_built(self):
+        with self.lock:
+            return self.summaries.is_built()
+
+    def rebuild_summaries(self, telegram_ids=None):
+        # Message counts start from the turns still stored
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO user_summaries "
+                    "(user_number, telegram_id, name, phone_number, message_count, last_active) "
+                    "SELECT CAST(u.user_number AS INTEGER), u.telegram_id, u.name, u.phone_number, "
+                    "COUNT(t.id), MAX(t.ts) "
+                    "FROM users u LEFT JOIN turns t ON t.user_number = u.user_number AND t.role != 'system' "
+                    "GROUP BY u.user_number"
+                )
+                # Older databases may not have stored the Telegram ID
+                self.conn.executemany(
+                    "UPDATE user_summaries SET telegram_id = ? WHERE user_number = ? AND telegram_id IS NULL",
+                    [(telegram_id, int(user_number)) for user_number, telegram_id in (telegram_ids or {}).items()]
+                )
+                self.summaries.mark_built()
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Built user summary index for {self.count_users()} user(s)")
+
+    def check_integrity(self, repair=True):
+        # SQLite recovers from crashes through its WAL by itself; this only reports damage
+        with self.lock:
+            rows = self.conn.execute("PRAGMA quick_check").fetchall()
+        if rows == [('ok',)]:
+            return 0
+        for row in rows:
+            logger.error(f"Integrity check of {self.db_path}: {row[0]}")
+        return len(rows)
+
+    def compact(self, user_number):
+        self.appended_turns.pop(user_number, None)
+        if not self.retention:
+            return
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM turns WHERE user_number = ? AND id NOT IN ("
+                "SELECT id FROM turns WHERE user_number = ? ORDER BY id DESC LIMIT ?)",
+                (user_number, user_number, self.retention)
+            )
+
+    def compact_pending(self):
+        # Cleared turns are deleted right away; retention is applied once a user may be `retention` turns over
+        for user_number in [n for n, count in self.appended_turns.items() if count >= self.retention]:
+            self.compact(user_number)
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def compact_all(self):
+        for user_number in self.user_numbers():
+            self.compact(user_number)
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_history_store(backend, data_dir, db_path=None, retention=0, committer=None, history_format=None):
+    # history_format only applies to the JSONL backend, SQLite keeps one row per turn
+    if backend == "jsonl":
+        serializer = Serializer.from_spec(history_format)
+        return JsonlHistoryStore(data_dir, retention=retention, committer=committer, serializer=serializer)
+    if backend == "sqlite":
+        return SqliteHistoryStore(db_path or os.path.join(data_dir, "history.db"), retention=retention)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate(user_index_file, data_dir, target):
+    # Imports legacy user_N.json documents (and anything already in JSONL form) into target
+    source = JsonlHistoryStore(data_dir)
+    user_index = {}
+    if os.path.exists(user_index_file):
+        with open(user_index_file, 'r') as f:
+            user_index = json.load(f)
+    telegram_ids = {data['user_number']: uid for uid, data in user_index.items()}
+    orphans = set(source.user_numbers()) - set(telegram_ids)
+    for user_number in sorted(orphans, key=int):
+        logger.warning(f"user_{user_number}.json is not in {user_index_file}, skipping it")
+
+    migrated = 0
+    for user_number, telegram_id in telegram_ids.items():
+        if not source.exists(user_number):
+            logger.warning(f"User {user_number} is in {user_index_file} but has no data file")
+            continue
+        if isinstance(target, JsonlHistoryStore):
+            migrated += target.migrate_legacy(user_number)
+        elif not target.exists(user_number):
+            target.create_user(user_number, source.load_user(user_number), telegram_id=telegram_id)
+            migrated += 1
+    logger.info(f"Migrated {migrated} user(s) into {type(target).__name__}")
+    return migrated
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram's hard limit for a single text message
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_point(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Prefer cutting at a paragraph, line or word boundary instead of mid-word
+    if len(text) <= limit:
+        return len(text)
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    chunks = []
+    while len(text) > limit:
+        cut = split_point(text, limit)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:]
+    chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """Shows a streamed LLM response as one Telegram message that is edited in place.
+
+    Edits are throttled to one per edit_interval seconds. When the text outgrows
+    Telegram's limit the current message is frozen and a new one is started.
+    With an outbox, sends and edits are queued behind the chat's other messages.
+    """
+
+    def __init__(self, message, edit_interval=1.0, limit=TELEGRAM_MESSAGE_LIMIT, outbox=None):
+        self.message = message
+        self.outbox = outbox
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.sent = None  # Telegram message currently being edited
+        self.text = ""  # Text belonging to the current message
+        self.shown = ""  # What Telegram currently displays for it
+        self.next_edit = 0.0
+        self.chunks = []
+
+    @property
+    def full_text(self):
+        return "".join(self.chunks)
+
+    async def push(self, delta):
+        self.chunks.append(delta)
+        self.text += delta
+        while len(self.text) > self.limit:
+            cut = split_point(self.text, self.limit)
+            head, self.text = self.text[:cut], self.text[cut:]
+            await self._show(head, force=True)
+            self.sent = None
+            self.shown = ""
+        if self.sent is None or time.monotonic() >= self.next_edit:
+            await self._show(self.text)
+
+    async def finish(self, suffix=""):
+        text = self.text + suffix
+        if len(text) > self.limit:
+            await self._show(self.text, force=True)
+            self.sent = None
+            self.shown = ""
+            text = suffix.strip()
+        await self._show(text, force=True)
+
+    async def _call(self, call, force):
+        if self.outbox is None:
+            return await call()
+        # The outbox retries forced sends through flood control and hands back RetryAfter for the rest
+        return await self.outbox.submit(self.message.chat_id, call, retry_flood=force)
+
+    async def _show(self, text, force=False):
+        if not text.strip() or text == self.shown:
+            return
+        while True:
+            try:
+                if self.sent is None:
+                    self.sent = await self._call(lambda: self.message.reply_text(text), force)
+                else:
+                    sent = self.sent
+                    await self._call(lambda: sent.edit_text(text), force)
+                break
+            except RetryAfter as e:
+                logger.warning(f"Telegram flood control while streaming, retry after {e.retry_after}s")
+                if not force:
+                    # Skip this intermediate edit, a later one will catch up
+                    self.next_edit = time.monotonic() + float(e.retry_after)
+                    return
+                await asyncio.sleep(float(e.retry_after))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                break
+        self.shown = text
+        self.next_edit = time.monotonic() + self.edit_interval
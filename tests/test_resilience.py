@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from resilience import CircuitBreaker, ResilientInference
+
+
+class FakePool:
+    model = "primary"
+
+    def __init__(self, error=None, delay=0.0):
+        self.error = error
+        self.delay = delay
+
+    async def complete(self, messages, model=None):
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return model
+
+    async def stream(self, messages, model=None):
+        for delta in ("a", "b", "c"):
+            await asyncio.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            yield delta
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+def half_open(inference):
+    # Leaves the primary's breaker open with its reset period already over
+    breaker = inference.breaker("primary")
+    breaker.record_failure()
+    breaker.opened_at -= inference.breaker_reset
+    return breaker
+
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold_and_lets_one_trial_through(self):
+        breaker = CircuitBreaker(threshold=2, reset_after=0)
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.end_trial()
+        self.assertTrue(breaker.allow())
+
+
+class TrialTest(unittest.IsolatedAsyncioTestCase):
+    def inference(self, pool):
+        return ResilientInference(pool, fallback_model="fallback", retries=0, backoff=0,
+                                  breaker_threshold=1, breaker_reset=30.0)
+
+    async def test_non_transient_error_closes_breaker(self):
+        inference = self.inference(FakePool(error=BadRequest()))
+        breaker = half_open(inference)
+        with self.assertRaises(BadRequest):
+            await inference.complete(MESSAGES)
+        self.assertFalse(breaker.is_open())
+        self.assertFalse(breaker.trial_running)
+
+    async def test_transient_error_keeps_breaker_open(self):
+        inference = self.inference(FakePool(error=httpx.ConnectError("down")))
+        breaker = half_open(inference)
+        with self.assertRaises(httpx.ConnectError):
+            await inference.complete(MESSAGES)
+        self.assertTrue(breaker.is_open())
+        self.assertFalse(breaker.trial_running)
+
+    async def test_cancelled_trial_is_released(self):
+        inference = self.inference(FakePool(delay=10))
+        breaker = half_open(inference)
+        task = asyncio.ensure_future(inference.complete(MESSAGES))
+        await asyncio.sleep(0)
+        self.assertTrue(breaker.trial_running)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertFalse(breaker.trial_running)
+        self.assertTrue(breaker.allow())
+
+    async def test_stream_cancelled_before_first_token_releases_trial(self):
+        inference = self.inference(FakePool(delay=10))
+        breaker = half_open(inference)
+
+        async def consume():
+            async for _ in inference.stream(MESSAGES):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0)
+        self.assertTrue(breaker.trial_running)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertFalse(breaker.trial_running)
+
+    async def test_stream_consumer_stopping_early_closes_breaker(self):
+        inference = self.inference(FakePool())
+        breaker = half_open(inference)
+        stream = inference.stream(MESSAGES)
+        self.assertEqual(await stream.__anext__(), "a")
+        await stream.aclose()
+        self.assertFalse(breaker.is_open())
+        self.assertFalse(breaker.trial_running)
+
+
+if __name__ == "__main__":
+    unittest.main()
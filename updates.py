@@ -0,0 +1,40 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently and each chat's updates one at a time.
+
+    ConversationHandler reads a chat's state when it checks an update, so two
+    updates from one chat handled at once would both see the old state. Handlers
+    that may overlap within a chat, like the message handler whose coalescer
+    waits for follow-up messages, are registered with block=False: the update
+    then counts as processed once the handler is started, and the chat's next
+    update goes ahead.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.chats = {}  # chat_id -> [lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        entry = self.chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass